@@ -0,0 +1,221 @@
+"""
+bench.py -- replay recorded terminal sessions through serial_repl.py and ezpyle.py under pico_sim.
+(C) 2022 B.M.Deeal
+distributed under the ISC license, see <https://opensource.org/licenses/ISC> for details
+
+Each session is the exact keystrokes a terminal would send (^M to submit, ^H to backspace, etc.),
+fed to a fresh copy of the scripts on a simulated 9600 baud UART with simulated time, so the
+200ms line pauses and the time spent pushing bytes down the wire are counted without waiting
+for them. For each session, this reports the bytes the device sent, the simulated wall time
+(what the person at the terminal would sit through), and the real CPU time the host took.
+
+    python bench.py                     #run everything, print a table
+    python bench.py --save base.json    #remember the results
+    python bench.py --compare base.json #fail if any session got slower in simulated time
+    python bench.py --session keys.txt --target repl  #replay your own recording
+
+Simulated time is deterministic, so --compare is strict (see --tolerance); CPU time is just
+reported, since it wobbles from run to run.
+"""
+import sys
+import os
+import time
+import json
+import tempfile
+import argparse
+import pico_sim
+
+#a few files for ls(), cat() and ezpyle to chew on
+sample_files={
+    "boot.py": "",
+    "main.py": "import serial_repl\nserial_repl.main()\n",
+    "notes.txt": "".join(f"line {ii} of some notes\n" for ii in range(40)),
+}
+#plus a directory with lots of files in it
+many_files=150
+
+def keys(*lines):
+    """join lines of typed text into the bytes a terminal would send, ^M after each"""
+    return "".join(f"{line}\r" for line in lines).encode("ascii")
+
+#recorded sessions: name -> (what to run it through, keystrokes)
+sessions={
+    "in_line_typing": ("in_line", keys(
+        "hello there",
+        "x=1+2",
+        "abcdef\x08\x08\x08def",
+        "\tindented\x08\x08",
+        "first\nsecond\nthird",
+        "typo here\x15fixed line",
+        "\x06",
+    )*10),
+    "repl_exprs": ("repl", keys(*[f"{ii}*{ii}" for ii in range(30)])),
+    "repl_loop_output": ("repl", keys(
+        "for ii in range(25):\n    out_line('progress', ii)",
+        "out_line('a', 'b', 'c', sep='-')",
+    )),
+    "repl_ls": ("repl", keys("ls()", "ls()", "ls()")),
+    "repl_ls_many": ("repl", keys("os.chdir('many')", "ls()", "", "", "os.chdir('..')")),
+    "repl_files": ("repl", keys("head('notes.txt')", "tail('notes.txt')", "grep('line 3', 'notes.txt')",
+        "cp('notes.txt', 'copy.txt')", "cat('copy.txt')", "", "rm('copy.txt')")),
+    "repl_help": ("repl", keys("show_help()", "", "show_help()", "q")),
+    "repl_errors": ("repl", keys("1/0", "undefined_name", "def f(:", "x=[1,2,3]", "x[10]")),
+    #memory numbers come from tracemalloc here, so they're only roughly what a Pico would show
+    "repl_mem": ("repl_traced", keys("mem()", "mem_report=True", "x=[0]*1000", "del x", "gc_ceiling=1", "y=1", "mem(True)")),
+    "ezpyle_edit": ("ezpyle", keys(
+        *[f"a\rline number {ii}" for ii in range(20)],
+        "j", "5", "r", "number", "NUMBER", "y",
+        "sp", "NUMBER", "y", "y",
+        "jn", "n", "y",
+        "st",
+        "la", "y", "",
+        "wf", "edited.txt",
+        "new",
+        "lf", "notes.txt",
+        "l", "",
+    )),
+    "ezpyle_listall": ("ezpyle", keys("lf", "notes.txt", "la", "", "", "", "")),
+    #power-up to the first prompt, with a bit of line noise on the way in
+    "startup": ("startup", b"\x00\xff\x00\xfe"),
+}
+
+def load_device(baudrate=9600):
+    """fresh serial_repl on a scripted, memory-backed UART with simulated time"""
+    clock=pico_sim.Clock()
+    pico_sim.install(clock)
+    repl=pico_sim.load("serial_repl", alias="serial_repl_bench")
+    repl.session0.uart.baudrate=baudrate
+    return repl, clock
+
+def drive_in_line(repl):
+    while True:
+        repl.in_line()
+
+def drive_repl(repl):
+    repl.repl()
+
+def drive_repl_traced(repl):
+    pico_sim.trace_memory()
+    try:
+        repl.repl()
+    finally:
+        pico_sim.trace_memory(False)
+
+def drive_ezpyle(repl):
+    ezpyle=pico_sim.load("ezpyle", alias="ezpyle_bench")
+    #same thing load_and_patch() does
+    ezpyle.input=repl.in_line
+    ezpyle.print=repl.out_line
+    ezpyle.c_file.clear()
+    while True:
+        ezpyle.mainloop()
+
+def drive_startup(repl):
+    repl.main()
+
+drivers={"in_line": drive_in_line, "repl": drive_repl, "repl_traced": drive_repl_traced, "ezpyle": drive_ezpyle, "startup": drive_startup}
+
+def run_session(target, keystrokes, baudrate=9600):
+    """
+    replay one session, returns a dict of measurements
+    startup sessions are timed from import (CPU included) to the first "REPL ready." being sent
+    """
+    cpu_start=time.process_time()
+    repl, clock=load_device(baudrate)
+    uart=repl.session0.uart
+    if target=="startup":
+        uart.feed(keystrokes, scripted=False)
+        uart.stop_after("REPL ready.")
+    else:
+        uart.feed(keystrokes)
+        cpu_start=time.process_time()
+    ops=max(keystrokes.count(b"\r"), 1)
+    try:
+        drivers[target](repl)
+    except pico_sim.Stop:
+        pass
+    cpu=time.process_time()-cpu_start
+    wall=uart.drained_ms()
+    return {
+        "ops": ops,
+        "bytes_sent": uart.bytes_sent,
+        "sim_ms": round(wall, 3),
+        "cpu_ms": round(cpu*1000, 3),
+        "sim_ms_per_op": round(wall/ops, 3),
+        "cpu_ms_per_op": round(cpu*1000/ops, 3),
+    }
+
+def run_all(selected, baudrate=9600):
+    """run the named sessions in a scratch directory with the sample files in it"""
+    results={}
+    start_dir=os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        for fname, text in sample_files.items():
+            with open(os.path.join(scratch, fname), "w") as f:
+                f.write(text)
+        os.mkdir(os.path.join(scratch, "many"))
+        for ii in range(many_files):
+            with open(os.path.join(scratch, "many", f"log{ii:04}.txt"), "w") as f:
+                f.write("x"*ii)
+        os.chdir(scratch)
+        try:
+            for name, (target, keystrokes) in selected.items():
+                results[name]=run_session(target, keystrokes, baudrate)
+        finally:
+            os.chdir(start_dir)
+    return results
+
+def show(results):
+    print(f"{'session':<20} {'ops':>5} {'bytes':>8} {'sim ms':>11} {'ms/op':>9} {'cpu ms':>9} {'cpu/op':>8}")
+    for name, r in results.items():
+        print(f"{name:<20} {r['ops']:>5} {r['bytes_sent']:>8} {r['sim_ms']:>11.1f} {r['sim_ms_per_op']:>9.1f} {r['cpu_ms']:>9.2f} {r['cpu_ms_per_op']:>8.3f}")
+
+def compare(results, baseline, tolerance):
+    """returns a list of complaints about sessions that got slower than the baseline"""
+    problems=[]
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        old=baseline[name]["sim_ms"]
+        if r["sim_ms"]>old*(1+tolerance)+0.001:
+            problems.append(f"{name}: {old:.1f} -> {r['sim_ms']:.1f} simulated ms")
+    return problems
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="benchmark serial_repl.py and ezpyle.py under pico_sim")
+    parser.add_argument("names", nargs="*", help="sessions to run (default: all)")
+    parser.add_argument("--baud", type=int, default=9600)
+    parser.add_argument("--session", help="file of raw keystrokes to replay instead")
+    parser.add_argument("--target", choices=sorted(drivers), default="repl", help="what --session is fed to")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="fail if slower than the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.0, help="allowed slowdown for --compare, as a fraction")
+    args=parser.parse_args(argv)
+    if args.session:
+        with open(args.session, "rb") as f:
+            selected={os.path.basename(args.session): (args.target, f.read())}
+    else:
+        unknown=[name for name in args.names if name not in sessions]
+        if unknown:
+            parser.error(f"unknown session(s): {', '.join(unknown)}")
+        selected={name: sessions[name] for name in (args.names or sessions)}
+    results=run_all(selected, args.baud)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        show(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems=compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"slower: {problem}")
+        if problems:
+            return 1
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
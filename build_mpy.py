@@ -0,0 +1,59 @@
+"""
+build_mpy.py -- precompile the device-side scripts to .mpy, so the Pico doesn't have to compile them at every start.
+(C) 2022 B.M.Deeal
+distributed under the ISC license, see <https://opensource.org/licenses/ISC> for details
+
+Needs mpy-cross, either the pip package (pip install mpy-cross) or the binary on your PATH.
+Its version has to match the MicroPython firmware on the Pico, or the .mpy files won't load.
+
+    python build_mpy.py              #writes mpy/serial_repl.mpy and mpy/ezpyle.mpy
+
+Copy the mpy folder to the root of the Pico. load_and_patch() looks there first (see mpy_dir in
+serial_repl.py). To have serial_repl itself load from there too, start it from main.py with:
+    import sys
+    sys.path.insert(0, "/mpy")
+    import serial_repl
+    serial_repl.main()
+
+Rebuild (and recopy) after changing a script, since the .mpy files win over the .py ones.
+"""
+import sys
+import os
+import argparse
+import subprocess
+
+here=os.path.dirname(os.path.abspath(__file__))
+scripts=["serial_repl.py", "ezpyle.py"]
+
+def mpy_cross(args):
+    """run mpy-cross with some arguments, using the pip package if it's installed"""
+    try:
+        import mpy_cross as mc
+    except ImportError:
+        mc=None
+    if mc is not None:
+        proc=mc.run(*args)
+        return proc.wait()
+    return subprocess.call(["mpy-cross", *args])
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="precompile serial_repl.py and ezpyle.py for the Pico")
+    parser.add_argument("--out", default=os.path.join(here, "mpy"), help="where to put the .mpy files")
+    parser.add_argument("--march", default="armv6m", help="native code architecture (the RP2040 is armv6m)")
+    args=parser.parse_args(argv)
+    os.makedirs(args.out, exist_ok=True)
+    for script in scripts:
+        out=os.path.join(args.out, script[:-3]+".mpy")
+        try:
+            status=mpy_cross([f"-march={args.march}", "-o", out, os.path.join(here, script)])
+        except FileNotFoundError:
+            print("error: mpy-cross not found! Try pip install mpy-cross.")
+            return 1
+        if status!=0:
+            print(f"error: could not compile {script}!")
+            return 1
+        print(f"Wrote {out}.")
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
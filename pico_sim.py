@@ -0,0 +1,365 @@
+"""
+pico_sim.py -- run serial_repl.py (and friends) under normal CPython, no Pico required.
+(C) 2022 B.M.Deeal
+distributed under the ISC license, see <https://opensource.org/licenses/ISC> for details
+
+This provides a fake machine module (UART, Pin, reset) and patches the MicroPython-only bits
+of time onto CPython's time module, so the device-side scripts can be imported on a PC.
+A fake UART either talks to a file descriptor (like one end of a pty pair) or just keeps
+everything in memory, which is handy for poking at things from a test.
+
+For benchmarking, install a Clock: time.sleep_ms() then advances simulated time instead of
+sleeping, and memory-backed UARTs charge each byte sent its transmit time at the set baud rate,
+so the numbers match what a slow terminal on the other end would actually see.
+
+Typical use, to get a pty that host tools can open as if it were a real serial port:
+    import pico_sim
+    port=pico_sim.serve_pty()
+    #now open port with serial_repl_client, screen, whatever
+"""
+import sys
+import os
+import time
+import types
+import threading
+import importlib.util
+import select
+import tty
+import gc
+import tracemalloc
+
+here=os.path.dirname(os.path.abspath(__file__))
+
+uart_fds={} #uart id -> file descriptor the next UART() for that id should use
+load_lock=threading.Lock() #uart_fds is only good for one import at a time
+clock=None #the simulated Clock, None for real time
+bits_per_char=10 #8N1: start bit, 8 data bits, stop bit
+tx_fifo=32 #bytes the RP2040 UART can hold before write() has to wait
+heap_size=192*1024 #pretend heap size, for gc.mem_free()
+heap_base=0 #what tracemalloc already counted when tracing started, so gc.mem_alloc() starts near 0
+
+class Reset(SystemExit):
+    """raised by the fake machine.reset(), since we can't really restart the PC"""
+
+class Stop(BaseException):
+    """
+    raised to end a simulation
+    not an Exception, so the REPL's catch-all doesn't swallow it
+    """
+
+class OutOfInput(Stop):
+    """raised when a scripted UART has nothing left to give"""
+
+class Clock:
+    """simulated time, in milliseconds -- only moves when something sleeps or waits on the UART"""
+    def __init__(self):
+        self.ms=0.0
+
+    def sleep_ms(self, ms):
+        self.ms+=ms
+
+    def sleep(self, s):
+        self.ms+=s*1000
+
+    def ticks_ms(self):
+        return int(self.ms)
+
+    def wait_until(self, ms):
+        if ms>self.ms:
+            self.ms=ms
+
+class UART:
+    """
+    fake machine.UART
+    backed by a file descriptor if one was attached for this id, otherwise by memory buffers
+    (rx is what the device reads, tx is what the device wrote)
+    """
+    def __init__(self, id, baudrate=115200, tx=None, rx=None, **kwargs):
+        self.id=id
+        self.baudrate=baudrate
+        self.rxbuf=kwargs.get("rxbuf", 256) #only remembered, a memory or pty UART can't overflow
+        self.fd=uart_fds.get(id)
+        self.rx=bytearray()
+        self.tx=bytearray()
+        self.scripted=False #if set, running out of rx data raises OutOfInput
+        self.clock=clock
+        self.busy_until=0.0 #simulated time the last queued byte finishes sending
+        self.bytes_sent=0
+        self.stop_text=None #if set, the device is stopped once it has sent this
+
+    def feed(self, data, scripted=True):
+        """
+        pretend the terminal sent some data (memory-backed UARTs only)
+        with scripted set, the device gets OutOfInput once it's all been read
+        """
+        if isinstance(data, str):
+            data=data.encode("ascii")
+        self.rx+=data
+        self.scripted=scripted
+
+    def stop_after(self, text):
+        """raise Stop once the device has sent some text (memory-backed UARTs only)"""
+        if isinstance(text, str):
+            text=text.encode("ascii")
+        self.stop_text=text
+
+    def char_ms(self):
+        """how long one character takes on the wire"""
+        return bits_per_char*1000/self.baudrate
+
+    def drained_ms(self):
+        """simulated time at which everything written so far has been sent"""
+        return max(self.busy_until, self.clock.ms)
+
+    def take(self):
+        """get and clear everything the device has sent so far (memory-backed UARTs only)"""
+        data=bytes(self.tx)
+        self.tx=bytearray()
+        return data
+
+    def any(self):
+        """how many bytes are waiting, waits very briefly on an fd so idle loops don't peg the CPU"""
+        if self.fd is None:
+            if len(self.rx)==0 and self.scripted:
+                raise OutOfInput()
+            return len(self.rx)
+        ready, _, _=select.select([self.fd], [], [], 0.001)
+        return 1 if ready else 0
+
+    def read(self, n=-1):
+        """read waiting bytes, None if there aren't any"""
+        if self.fd is None:
+            if len(self.rx)==0:
+                return None
+            if n<0:
+                n=len(self.rx)
+            data=bytes(self.rx[:n])
+            del self.rx[:n]
+            return data
+        ready, _, _=select.select([self.fd], [], [], 0)
+        if not ready:
+            return None
+        try:
+            data=os.read(self.fd, 4096 if n<0 else n)
+        except OSError:
+            #the other end of the pty went away
+            return None
+        return data if len(data)>0 else None
+
+    def write(self, data):
+        """send bytes (or a str, like MicroPython allows)"""
+        if isinstance(data, str):
+            data=data.encode("utf-8")
+        self.bytes_sent+=len(data)
+        if self.fd is None:
+            self.tx+=data
+            if self.clock is not None:
+                self.charge(len(data))
+            if self.stop_text is not None and self.stop_text in self.tx[-len(self.stop_text)-len(data):]:
+                raise Stop()
+            return len(data)
+        view=memoryview(data)
+        while len(view)>0:
+            try:
+                sent=os.write(self.fd, view)
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+                continue
+            view=view[sent:]
+        return len(data)
+
+    def charge(self, n):
+        """
+        account for sending n bytes: they queue up behind anything still being sent,
+        and write() only returns once whatever doesn't fit in the FIFO has gone out
+        """
+        per=self.char_ms()
+        self.busy_until=max(self.busy_until, self.clock.ms)+n*per
+        self.clock.wait_until(self.busy_until-tx_fifo*per)
+
+class Pin:
+    """fake machine.Pin, just remembers its value"""
+    IN=0
+    OUT=1
+    def __init__(self, id, mode=-1, *args, **kwargs):
+        self.id=id
+        self.mode=mode
+        self.v=0
+    def value(self, v=None):
+        if v is None:
+            return self.v
+        self.v=1 if v else 0
+    def on(self):
+        self.v=1
+    def off(self):
+        self.v=0
+    def toggle(self):
+        self.v=1-self.v
+
+def reset():
+    """fake machine.reset()"""
+    raise Reset()
+
+def ticks_ms():
+    return int(time.monotonic()*1000)
+
+def ticks_diff(a, b):
+    return a-b
+
+def ticks_add(a, b):
+    return a+b
+
+def ilistdir(path="."):
+    """MicroPython's os.ilistdir: (name, type, inode, size) for each entry"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            st=entry.stat()
+            kind=0x4000 if entry.is_dir() else 0x8000
+            yield (entry.name, kind, st.st_ino, st.st_size)
+
+def mem_alloc():
+    """MicroPython's gc.mem_alloc(): what tracemalloc sees since trace_memory(), if it's running (otherwise 0)"""
+    if tracemalloc.is_tracing():
+        return max(tracemalloc.get_traced_memory()[0]-heap_base, 0)
+    return 0
+
+def mem_free():
+    """MicroPython's gc.mem_free(), out of a pretend heap_size heap"""
+    return max(heap_size-mem_alloc(), 0)
+
+def trace_memory(on=True):
+    """
+    start (or stop) tracemalloc, so gc.mem_alloc() and gc.mem_free() report something
+    usage is counted from when tracing starts; Python runs quite a bit slower while it's on
+    """
+    global heap_base
+    if not on:
+        tracemalloc.stop()
+    elif not tracemalloc.is_tracing():
+        tracemalloc.start()
+        heap_base=tracemalloc.get_traced_memory()[0]
+
+def install(sim_clock=None, trace=False):
+    """
+    put the fake machine module in place and add the MicroPython time functions
+    with a Clock, time.sleep_ms() and friends use simulated time, and so do UARTs made afterwards
+    with trace set, memory use is traced too, so mem() and gc_ceiling have real numbers to work with
+    """
+    global clock
+    clock=sim_clock
+    if "machine" not in sys.modules or not getattr(sys.modules["machine"], "is_pico_sim", False):
+        m=types.ModuleType("machine")
+        m.is_pico_sim=True
+        m.UART=UART
+        m.Pin=Pin
+        m.reset=reset
+        sys.modules["machine"]=m
+    if clock is not None:
+        time.sleep_ms=clock.sleep_ms
+        time.ticks_ms=clock.ticks_ms
+    else:
+        time.sleep_ms=lambda ms: time.sleep(ms/1000)
+        time.ticks_ms=ticks_ms
+    time.ticks_diff=ticks_diff
+    time.ticks_add=ticks_add
+    if not hasattr(os, "ilistdir"):
+        os.ilistdir=ilistdir
+    if not hasattr(gc, "mem_alloc"):
+        gc.mem_alloc=mem_alloc
+        gc.mem_free=mem_free
+    if trace:
+        trace_memory()
+
+def load(name="serial_repl", uarts=None, alias=None):
+    """
+    import a fresh copy of one of the device-side scripts
+    uarts maps uart ids to file descriptors for any UARTs the script creates while importing
+    alias is the module name to use, so several copies (several fake Picos) can coexist
+    call install() first if you want simulated time
+    """
+    if "machine" not in sys.modules:
+        install()
+    if alias is None:
+        alias=name
+    spec=importlib.util.spec_from_file_location(alias, os.path.join(here, f"{name}.py"))
+    module=importlib.util.module_from_spec(spec)
+    with load_lock:
+        uart_fds.clear()
+        uart_fds.update(uarts or {})
+        try:
+            spec.loader.exec_module(module)
+            #serial_repl doesn't set up UART0 until it's used, so do it now while the fds are in place
+            if 0 in uart_fds and hasattr(module, "open_uart0"):
+                module.open_uart0()
+        finally:
+            uart_fds.clear()
+    return module
+
+def open_pty():
+    """make a raw pty pair, returns (device fd, port path for the host side)"""
+    device, host=os.openpty()
+    #no line discipline, we want exactly the bytes a real UART would give us
+    tty.setraw(host)
+    tty.setraw(device)
+    return device, os.ttyname(host)
+
+pty_count=0
+
+def serve_pty(wait_period=0, led_enable=False, trace=False):
+    """
+    start a fake Pico running serial_repl on a new pty, in a background thread
+    returns the port path for the host side
+    wait_period defaults to 0, since a pty doesn't need time to redraw
+    trace turns on memory tracing, see install()
+    """
+    global pty_count
+    install(trace=trace)
+    device, port=open_pty()
+    pty_count+=1
+    repl=load("serial_repl", {0: device}, alias=f"serial_repl_sim{pty_count}")
+    repl.wait_period=wait_period
+    repl.led_enable=led_enable
+    thread=threading.Thread(target=run_quietly, args=(repl.repl,), daemon=True)
+    thread.start()
+    return port
+
+def serve_pty_pair(wait_period=0, led_enable=False, trace=False):
+    """
+    like serve_pty(), but with a second REPL session on UART1 (on its own thread, like core 1)
+    returns the port paths for UART0 and UART1
+    """
+    global pty_count
+    install(trace=trace)
+    device0, port0=open_pty()
+    device1, port1=open_pty()
+    pty_count+=1
+    repl=load("serial_repl", {0: device0, 1: device1}, alias=f"serial_repl_sim{pty_count}")
+    repl.wait_period=wait_period
+    repl.led_enable=led_enable
+    with load_lock:
+        uart_fds[1]=device1
+        try:
+            uart1=repl.UART(1, baudrate=9600, tx=repl.Pin(4), rx=repl.Pin(5), rxbuf=repl.uart_rxbuf)
+        finally:
+            uart_fds.clear()
+    repl.start_session(uart1)
+    thread=threading.Thread(target=run_quietly, args=(repl.session0.run,), daemon=True)
+    thread.start()
+    return port0, port1
+
+def run_quietly(fn):
+    """run a device main loop, treating bye()/reboot() as a normal way to stop"""
+    try:
+        fn()
+    except SystemExit:
+        pass
+
+if __name__=="__main__":
+    #handy for trying things by hand: python pico_sim.py, then point a terminal at the port
+    print(f"serial_repl is running on {serve_pty(wait_period=200)}")
+    print("^C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -10,165 +10,986 @@ Configure your device to emit only ^M (CR) for enter, and ^H for backspace. Disa
 Pressing ^J will emit a newline (LF), which will allow you to add multiple lines to your input.
 Run show_help() to see the rest of the available keys.
 load_and_patch() monkey-patches the print/input functions for any scripts you want to load and run.
+
+Host tooling can press ^A at an empty prompt to switch to the raw (machine) REPL, see Session.raw_repl().
+
+Each terminal gets its own Session, so UART0 and UART1 (or a UART and USB) can each run a REPL at once.
+The extra session runs on its own thread, which MicroPython puts on the RP2040's second core.
+The extra session gets its own variables (a copy of this module's, taken when it starts), since the two cores
+have no lock between them; out_line() and friends go to whichever session called them.
+
+With tx_offload set, output is queued and sent (line pauses and all) from the second core instead, so
+a program printing lots of lines keeps running while the terminal catches up. That uses up the spare
+core, so it can't be combined with a second session on the Pico.
+
+For a faster start, precompile this and ezpyle.py with build_mpy.py and copy the mpy folder over;
+load_and_patch() will pick up the .mpy versions from mpy_dir if they're there.
 """
 import machine
 from machine import UART, Pin
 import time
 import os
 import sys
-uart0 = UART(0, baudrate=9600, tx=Pin(0), rx=Pin(1))
+import struct
+import _thread
+import builtins
+import gc
+uart0=None #set up on first use, see open_uart0()
+led=None #likewise, see open_led()
 
 debug=False #mostly enables some debug info on stdout
 led_enable=True #enables the LED flashing when you type (you might want to disable this if your program uses the LED)
 true_tty=False #disables moving the cursor backwards with backspace since that'll overtype
 wait_period=200 #how many ms to wait between lines
+uart_rxbuf=1024 #UART receive buffer, in bytes (the rp2 default is 256, too small for a host pipelining raw REPL frames)
+raw_enable=True #allows ^A at an empty prompt to enter the raw REPL (for host tooling)
+uart1_enable=False #main() also serves a REPL on UART1 (GP4 TX, GP5 RX) on the second core
+garbage_quiet_ms=50 #at startup, the UART has to be quiet this long before we trust it
+garbage_wait_max=900 #...but don't wait more than this for it
+mpy_dir="/mpy" #where load_and_patch() looks for precompiled .mpy files first
+mem_report=False #after each line the REPL runs, show how memory use changed
+gc_ceiling=None #if set, collect garbage whenever more than this many bytes are in use while waiting for input (for long ezpyle sessions)
+usb_enable=False #main() also serves a REPL over USB on the second core (the Pico only has one spare core, so not both)
+tx_offload=False #main() sends UART0 output from the second core, so line pauses don't hold up running code
+tx_queue_size=256 #how much output can be waiting to send before out_line() and friends have to wait
+term_width=80 #how many characters fit on a line of the terminal
+page_lines=20 #how many lines to show before asking to show more
+ls_column=16 #ls() lines names up in columns this wide
+file_chunk=256 #bytes read at a time by cat(), grep(), cp() and friends; also the longest line they'll hold at once
+raw_out_chunk=256 #the raw REPL sends output in an O frame once about this many characters are waiting
+raw_frame_max=4096 #longest frame payload the raw REPL will accept from the host
 
-if led_enable:
-    led = Pin(25, Pin.OUT)
+def open_uart0():
+    """set up UART0 the first time it's needed, returns it"""
+    global uart0
+    if uart0 is None:
+        uart0=UART(0, baudrate=9600, tx=Pin(0), rx=Pin(1), rxbuf=uart_rxbuf)
+    return uart0
 
-def sleep_wait_period():
-    """wait for the set period of time so we don't bog down the device (a slow CE system with software text scrolling)"""
-    time.sleep_ms(wait_period)
+def open_led():
+    """set up the LED pin the first time it's needed, returns it"""
+    global led
+    if led is None:
+        led=Pin(25, Pin.OUT)
+    return led
 
 def set_led_on():
     """turn on the LED if LED control enabled"""
     if led_enable:
-        led.on()
-        
+        open_led().on()
+
 def set_led_off():
     """turn off the LED if LED control enabled"""
     if led_enable:
-        led.off()
+        open_led().off()
+
+class StdioPort:
+    """
+    makes USB (stdin/stdout) look enough like a UART for a Session
+    only any(), read() and write() are provided
+    """
+    def __init__(self):
+        import select
+        self.poll=select.poll()
+        self.poll.register(sys.stdin, select.POLLIN)
+        #otherwise ^C on the USB terminal interrupts whatever the main thread (the UART0 session) is doing
+        try:
+            import micropython
+            micropython.kbd_intr(-1)
+        except ImportError:
+            pass
+
+    def any(self):
+        return 1 if len(self.poll.poll(0))>0 else 0
+
+    def read(self):
+        return sys.stdin.buffer.read(1)
+
+    def write(self, s):
+        if isinstance(s, str):
+            sys.stdout.write(s)
+        else:
+            sys.stdout.buffer.write(s)
+
+class TxQueue:
+    """
+    output waiting to be sent to a terminal, drained by run() on another thread (the second core, on the Pico)
+    holds strings/bytes to send, and ints for line pauses (in ms)
+    once size characters are waiting, put() waits for the worker to catch up
+    """
+    def __init__(self, uart, size=None):
+        self.uart=uart
+        if size is None:
+            size=tx_queue_size
+        self.size=size
+        self.items=[]
+        self.queued=0 #characters (or pauses) added but not sent yet
+        self.lock=_thread.allocate_lock()
+        self.running=True
+        self.done=False #set once run() has returned
+
+    def put(self, item, n):
+        """add to the queue, waiting for room if it's full (anything fits in an empty queue)"""
+        while True:
+            self.lock.acquire()
+            if self.queued==0 or self.queued+n<=self.size:
+                self.items.append(item)
+                self.queued+=n
+                self.lock.release()
+                return
+            self.lock.release()
+            time.sleep_ms(1)
+
+    def write(self, data):
+        """queue some output"""
+        self.put(data, len(data))
+
+    def pause(self, ms):
+        """queue a line pause"""
+        self.put(ms, 1)
+
+    def run(self):
+        """worker loop: send everything as it shows up, until stop()"""
+        try:
+            self.send_loop()
+        finally:
+            self.done=True
+
+    def send_loop(self):
+        """the guts of run()"""
+        while True:
+            item=None
+            self.lock.acquire()
+            if len(self.items)>0:
+                item=self.items.pop(0)
+            self.lock.release()
+            if item is None:
+                if not self.running:
+                    return
+                time.sleep_ms(1)
+                continue
+            if isinstance(item, int):
+                time.sleep_ms(item)
+                n=1
+            else:
+                self.uart.write(item)
+                n=len(item)
+            self.lock.acquire()
+            self.queued-=n
+            self.lock.release()
+
+    def flush(self):
+        """wait until everything queued so far has been sent"""
+        while self.queued>0:
+            time.sleep_ms(1)
+
+    def stop(self):
+        """send what's left, then wait for the worker to finish (so its thread, and core, is free again)"""
+        self.flush()
+        self.running=False
+        while not self.done:
+            time.sleep_ms(1)
+
+class Session:
+    """
+    everything about one attached terminal: where it is, what's been typed, what's still to be read
+    uart is anything with any(), read() and write() -- a machine.UART or a StdioPort
+    None means UART0, which isn't set up until it's actually used
+    wait_period overrides the module setting for this terminal if given
+    names is the dict code typed at this terminal runs in, None for this module's globals
+    """
+    def __init__(self, uart=None, wait_period=None, names=None):
+        self.port=uart
+        self.wait_period=wait_period
+        self.names=globals() if names is None else names
+        self.in_line_prev=[] #last submitted line, for ^F
+        self.in_pending=b"" #bytes read from the terminal but not consumed yet
+        self.out_capture=None #when a list, terminal output is collected here instead of being sent (used by the raw REPL)
+        self.out_captured=0 #characters waiting in out_capture
+        self.tx=None #TxQueue, if output is being sent from another thread
+
+    @property
+    def uart(self):
+        if self.port is None:
+            self.port=open_uart0()
+        return self.port
+
+    def drain_garbage(self):
+        """
+        throw away input until the line has been quiet for garbage_quiet_ms
+        (the pico spews a bit of garbage at power-up), giving up after garbage_wait_max
+        """
+        start=time.ticks_ms()
+        last=start
+        while True:
+            now=time.ticks_ms()
+            if self.uart.any()>0:
+                self.uart.read()
+                last=now
+            elif time.ticks_diff(now, last)>=garbage_quiet_ms:
+                return
+            if time.ticks_diff(now, start)>=garbage_wait_max:
+                return
+            time.sleep_ms(1)
+
+    def offload_tx(self, size=None):
+        """send this terminal's output from a new thread (the second core, on the Pico) from now on"""
+        self.tx=TxQueue(self.uart, size)
+        _thread.start_new_thread(self.tx.run, ())
+
+    def stop_tx(self):
+        """stop offloading output, once everything queued has been sent"""
+        if self.tx is not None:
+            self.tx.stop()
+            self.tx=None
+
+    def send(self, data):
+        """write straight to the terminal, or to the queue if output is offloaded"""
+        if self.tx is not None:
+            self.tx.write(data)
+        else:
+            self.uart.write(data)
+
+    def flush(self):
+        """wait for any queued output to be sent"""
+        if self.tx is not None:
+            self.tx.flush()
+        #and out of the UART's own buffer, where the port can tell us (newer MicroPython only)
+        wait=getattr(self.uart, "flush", None)
+        if wait is not None:
+            wait()
+
+    def sleep_wait_period(self):
+        """wait for the set period of time so we don't bog down the device (a slow CE system with software text scrolling)"""
+        #captured output isn't going to a slow terminal, so don't bother waiting
+        if self.out_capture is not None:
+            return
+        ms=wait_period
+        if self.wait_period is not None:
+            ms=self.wait_period
+        #if output is offloaded, the pause happens over there, between the lines it sends
+        if self.tx is not None:
+            self.tx.pause(ms)
+        else:
+            time.sleep_ms(ms)
+
+    def out_chr(self, n):
+        """write a character index to the attached terminal"""
+        self.out_str(chr(n))
+
+    def out_str(self, s=""):
+        """write a string, no newline, to the attached terminal"""
+        if self.out_capture is not None:
+            s=str(s)
+            self.out_capture.append(s)
+            self.out_captured+=len(s)
+            #don't let a long listing pile up in RAM, send it on as it comes
+            if self.out_captured>=raw_out_chunk:
+                self.raw_send_output()
+            return
+        self.send(str(s))
+
+    def out_nl(self):
+        """write a newline to the attached terminal"""
+        self.out_str("\r\n")
+        self.sleep_wait_period()
+
+    def out_line(self, *args, **kwargs):
+        """
+        write a full line to the attached terminal
+        supports end and sep parameters
+        defers to print if a file param other than stdout is provided
+        """
+        #actually call print if it redirects
+        if "file" in kwargs and kwargs["file"]!=sys.stdout:
+            builtins.print(*args, **kwargs)
+            return
+        end="\r\n"
+        sep=" "
+        if "end" in kwargs:
+            end=kwargs["end"]
+        if "sep" in kwargs:
+            sep=kwargs["sep"]
+        for ii,s in enumerate(args):
+            self.out_str(s)
+            if ii != len(args)-1:
+                self.out_str(sep)
+        self.out_str(end)
+        if "\n" in end:
+            self.sleep_wait_period()
+
+    def in_bytes(self):
+        """
+        read whatever is waiting on the attached terminal
+        returns anything left over from a previous read first
+        returns an empty bytes object if nothing is waiting
+        """
+        if len(self.in_pending)>0:
+            data=self.in_pending
+            self.in_pending=b""
+            return data
+        if self.uart.any()>0:
+            data=self.uart.read()
+            if data is not None:
+                return data
+        return b""
+
+    def in_exact(self, n):
+        """read exactly n bytes from the attached terminal, waiting as needed"""
+        data=b""
+        while len(data)<n:
+            data+=self.in_bytes()
+        #keep anything we read past the end for next time
+        self.in_pending=data[n:]+self.in_pending
+        return data[:n]
+
+    def in_line(self, txt="", allow_raw=False):
+        """
+        read a line from the attached terminal
+        if allow_raw is set, ^A on an empty line runs the raw REPL and returns None after it exits
+        """
+        line=[]
+        #a good time to tidy up, nothing much is going on while someone types
+        mem_check()
+        self.out_str(txt)
+        while True:
+            #check if any data is to be read
+            set_led_off()
+            data=self.in_bytes()
+            if len(data)>0:
+                for ii,ch in enumerate(data):
+                    set_led_on()
+                    #accept entry
+                    if ch==13: #enter/carriage return -- my device doesn't do \n, just \r
+                        #keep anything typed after the enter for the next read
+                        self.in_pending=data[ii+1:]+self.in_pending
+                        #join everything into a final result
+                        result=bytes(line).decode("ascii")
+                        set_led_off()
+                        if debug:
+                            print(f"sent '{result}'")
+                        self.out_nl()
+                        self.in_line_prev=line
+                        return result
+                    #switch to the raw REPL, everything after the ^A belongs to it
+                    if ch==1 and allow_raw and raw_enable and len(line)==0: #SOH, generated by ^A
+                        self.in_pending=data[ii+1:]+self.in_pending
+                        set_led_off()
+                        self.raw_repl()
+                        return None
+                    #debug print info
+                    if debug:
+                        print(f"{ch}='{chr(ch)}'")
+                    #accept a newline as something you can enter
+                    if ch==10:
+                        self.out_line("\\") #emit a character to indicate
+                        line.append(ch)
+                    #echo typed valid characters (so, don't use local echo)
+                    if (ch>=32 and ch<=126): #printable characters
+                        self.out_chr(ch)
+                        line.append(ch)
+                    #we don't bother with real tabs on input
+                    if ch==9: #tab
+                        self.out_str("    ")
+                        line.append(ch)
+                    #clear buffer
+                    if ch==21: #NAK, generated by ^U
+                        line=[]
+                        self.out_line("...erased\\")
+                    #load previously typed input
+                    #TODO: refactor character output
+                    if ch==6: #ACK, generated by ^F
+                        self.out_line("...loaded\\")
+                        line=self.in_line_prev.copy()
+                        for cc in line:
+                            if cc==10:
+                                self.out_line("\\")
+                                self.out_nl()
+                            elif cc==9:
+                                self.out_str("    ")
+                            else:
+                                self.out_chr(cc)
+                    #backspace -- mostly does the right thing visually, breaks on my terminal if the text crosses to a newline
+                    if ch==8 and len(line)>0:
+                        prev_ch=line.pop()
+                        if not true_tty:
+                            #undo the last 4 spaces for tab
+                            if prev_ch==9:
+                                self.out_chr(8)
+                                self.out_chr(8)
+                                self.out_chr(8)
+                                self.out_chr(8)
+                                #forces the cursor to update
+                                self.out_chr(32)
+                                self.out_chr(8)
+                            #any single-character, we can go back, clear, go back
+                            else:
+                                self.out_chr(8)
+                                self.out_chr(32)
+                                self.out_chr(8)
+                        else:
+                            self.out_str("^H")
+
+    def pause_for_more(self):
+        """
+        ask to continue
+        returns False if user enters text starting with q (like quit)
+        otherwise, returns True
+        never asks when the raw REPL is collecting output, since the input is the host's frames
+        """
+        if self.out_capture is not None:
+            return True
+        result=self.in_line("Show more? (q to cancel)").strip().lower()
+        return not (result!="" and result[0]=="q")
+
+    def raw_send(self, kind, payload=b""):
+        """write a single frame to the attached terminal, no pacing or echo"""
+        self.send(struct.pack(">BI", kind[0], len(payload)))
+        if len(payload)>0:
+            self.send(payload)
+
+    def raw_send_output(self):
+        """send the output collected so far in an O frame, and start collecting afresh"""
+        data="".join(self.out_capture).encode("utf-8")
+        self.out_capture=[]
+        self.out_captured=0
+        self.raw_send(b"O", data)
+
+    def raw_recv(self):
+        """
+        read a single frame from the attached terminal, returns (kind, payload)
+        a kind byte we don't know (including ^B) comes back on its own, no length or payload is read for it
+        a frame longer than raw_frame_max comes back with a None payload, and nothing past its length is read
+        """
+        kind=self.in_exact(1)
+        if kind not in raw_kinds:
+            return kind, b""
+        size,=struct.unpack(">I", self.in_exact(4))
+        if size>raw_frame_max:
+            return kind, None
+        return kind, self.in_exact(size)
+
+    def raw_exec(self, src):
+        """
+        evaluate a block of source like repl() does, but collect everything instead of sending it
+        returns (stdout, result, exception, stop): strings, empty if there was nothing,
+        and the SystemExit if the code tried to leave (bye(), reboot()), so it can be passed on after answering
+        print is pointed at raw_print, so anything printed gets collected too
+        output is sent ahead in O frames as it piles up, stdout is just whatever is left at the end
+        """
+        stop=None
+        result=None
+        error=""
+        g=self.names
+        saved_print=g.get("print")
+        g["print"]=raw_print
+        self.out_capture=[]
+        self.out_captured=0
+        try:
+            try:
+                result=eval(src, g)
+            #same eval/exec dance as repl()
+            except SyntaxError:
+                exec(src, g)
+        #anything at all, the host still needs its D frame
+        except BaseException as ex:
+            error=f"{type(ex).__name__}: {ex}"
+            if isinstance(ex, SystemExit):
+                stop=ex
+        finally:
+            stdout="".join(self.out_capture)
+            self.out_capture=None
+            self.out_captured=0
+            if saved_print is None:
+                del g["print"]
+            else:
+                g["print"]=saved_print
+        if result is None:
+            return stdout, "", error, stop
+        return stdout, repr(result), error, stop
+
+    def raw_repl(self):
+        """
+        machine-friendly REPL for host tooling, entered with ^A at an empty prompt
+        reads E frames, runs them, answers each one with a D frame (after any O frames of output)
+        returns to the normal REPL on a B frame, or on a lone ^B (for a human who got here by accident)
+        """
+        self.raw_send(b"R", raw_version.encode("utf-8"))
+        while True:
+            kind, payload=self.raw_recv()
+            if payload is None:
+                #most likely a garbled length, so whatever follows can't be trusted either
+                self.raw_send(b"D", raw_field("")+raw_field("")+raw_field(f"ValueError: frame longer than {raw_frame_max} bytes"))
+                self.in_pending=b""
+                self.drain_garbage()
+                continue
+            if kind==b"E":
+                set_led_on()
+                try:
+                    src=payload.decode("utf-8")
+                except Exception as ex:
+                    self.raw_send(b"D", raw_field("")+raw_field("")+raw_field(f"{type(ex).__name__}: {ex}"))
+                    continue
+                stdout, result, error, stop=self.raw_exec(src)
+                set_led_off()
+                self.raw_send(b"D", raw_field(stdout)+raw_field(result)+raw_field(error))
+                #the code asked to leave, now that the host has its answer we can
+                if stop is not None:
+                    self.flush()
+                    if isinstance(stop, Reboot):
+                        machine.reset()
+                    raise stop
+            elif kind==b"B":
+                self.raw_send(b"B")
+                return
+            elif kind==b"\x02": #STX, generated by ^B
+                self.out_nl()
+                self.out_line("...left raw REPL")
+                return
+            #not a frame at all, skip the byte and try again
+
+    def repl(self):
+        """main read-eval-print loop"""
+        #intro text, two newlines to skip past any garbage that may have been sent
+        self.out_nl()
+        self.out_nl()
+        self.out_line("Type show_help() to view help.")
+        self.out_line("^M will submit input.")
+        self.out_line("REPL ready.")
+        while True:
+            #^C shouldn't take the whole REPL down, even from inside the exec in repl_line()
+            try:
+                self.repl_line()
+            except KeyboardInterrupt:
+                self.out_nl()
+                self.out_line("Keyboard interrupt.")
+
+    def repl_line(self):
+        """read and evaluate a single line of input, for repl()"""
+        before=None
+        try:
+            self.out_str(">>>")
+            user_input=self.in_line(allow_raw=True)
+            #came back from the raw REPL, just prompt again
+            if user_input is None:
+                return
+            if mem_report:
+                before=mem_mark()
+            result=eval(user_input, self.names)
+            if result is not None:
+                self.out_line(result)
+        #we try to emit the result if we can, so we have to switch between eval and exec
+        #if exec returned a value, none of this would be needed
+        except SyntaxError:
+            try:
+                exec(user_input, self.names)
+            #real syntax error
+            except Exception as ex2:
+                self.out_line(ex2)
+        #could not parse
+        except Exception as ex:
+            self.out_line(ex)
+        if before is not None:
+            mem_show_change(before)
+
+    def run(self):
+        """run the REPL, with this session as the one the module-level functions use on this thread"""
+        sessions[_thread.get_ident()]=self
+        try:
+            self.repl()
+        finally:
+            del sessions[_thread.get_ident()]
+
+session0=Session() #the UART0 terminal, used by anything not running in another session
+sessions={} #thread id -> the Session running on that thread
+
+def current():
+    """the session for whoever is calling"""
+    return sessions.get(_thread.get_ident(), session0)
+
+#these all act on the calling session, so scripts (and load_and_patch) don't need to know which terminal they're on
+def sleep_wait_period():
+    """wait for the set period of time so we don't bog down the device (a slow CE system with software text scrolling)"""
+    current().sleep_wait_period()
 
 def out_chr(n):
     """write a character index to the attached terminal"""
-    uart0.write(chr(n))
+    current().out_chr(n)
 
 def out_str(s=""):
     """write a string, no newline, to the attached terminal"""
-    uart0.write(str(s))
+    current().out_str(s)
 
 def out_nl():
     """write a newline to the attached terminal"""
-    uart0.write("\r\n")
-    sleep_wait_period()
+    current().out_nl()
 
 def out_line(*args, **kwargs):
-    """
-    write a full line to the attached terminal
-    supports end and sep parameters
-    defers to print if a file param other than stdout is provided
-    """
-    #actually call print if it redirects
-    if "file" in kwargs and kwargs["file"]!=sys.stdout:
-        print(*args, **kwargs)
-        return
-    end="\r\n"
-    sep=" "
-    if "end" in kwargs:
-        end=kwargs["end"]
-    if "sep" in kwargs:
-        sep=kwargs["sep"]
-    for ii,s in enumerate(args):
-        out_str(s)
-        if ii != len(args)-1:
-            out_str(sep)
-    out_str(end)
-    if "\n" in end:
-        sleep_wait_period()
-
-def in_line(txt=""):
-    """read a line from the attached terminal"""
-    global in_line_prev
-    line=[]
-    out_str(txt)
-    while True:
-        #check if any data is to be read
-        set_led_off()
-        if uart0.any()>0:
-            for ch in uart0.read():
-                set_led_on()
-                #accept entry
-                if ch==13: #enter/carriage return -- my device doesn't do \n, just \r
-                    #join everything into a final result
-                    result=bytes(line).decode("ascii")
-                    set_led_off()
-                    if debug:
-                        print(f"sent '{result}'")
-                    out_nl()
-                    in_line_prev=line
-                    return result
-                #debug print info
-                if debug:
-                    print(f"{ch}='{chr(ch)}'")
-                #accept a newline as something you can enter
-                if ch==10:
-                    out_line("\\") #emit a character to indicate
-                    line.append(ch)
-                #echo typed valid characters (so, don't use local echo)
-                if (ch>=32 and ch<=126): #printable characters
-                    out_chr(ch) #uart0.write(chr(ch))
-                    line.append(ch)
-                #we don't bother with real tabs on input
-                if ch==9: #tab
-                    out_str("    ")
-                    line.append(ch)
-                #clear buffer
-                if ch==21: #NAK, generated by ^U
-                    line=[]
-                    out_line("...erased\\")
-                #load previously typed input
-                #TODO: refactor character output
-                if ch==6: #ACK, generated by ^F
-                    out_line("...loaded\\")
-                    line=in_line_prev.copy()
-                    for cc in line:
-                        if cc==10:
-                            out_line("\\")
-                            out_nl()
-                        elif cc==9:
-                            out_str("    ")
-                        else:
-                            out_chr(cc)
-                #backspace -- mostly does the right thing visually, breaks on my terminal if the text crosses to a newline
-                if ch==8 and len(line)>0:
-                    prev_ch=line.pop()
-                    if not true_tty:
-                        #undo the last 4 spaces for tab
-                        if prev_ch==9:
-                            out_chr(8)
-                            out_chr(8)
-                            out_chr(8)
-                            out_chr(8)
-                            #forces the cursor to update
-                            out_chr(32)
-                            out_chr(8)
-                        #any single-character, we can go back, clear, go back
-                        else:
-                            out_chr(8)
-                            out_chr(32)
-                            out_chr(8)
-                    else:
-                        out_str("^H")
-in_line_prev=[] #dirty hack; this whole program needs a refactor
+    """write a full line to the attached terminal, see Session.out_line"""
+    current().out_line(*args, **kwargs)
+
+def in_line(txt="", allow_raw=False):
+    """read a line from the attached terminal, see Session.in_line"""
+    return current().in_line(txt, allow_raw)
 
 def input_test():
     """for testing whether things work"""
     out_nl()
-    uart0.write("test data: ")
+    out_str("test data: ")
     in_line()
 
-def ls(location="."):
-    """show a listing of the current directory"""
-    for fname in os.listdir():
-        out_line(fname)
+def ls_rows(location=".", long=False):
+    """
+    generate the lines of a directory listing, reading the directory as it goes
+    normally packs as many names on a line as fit, in columns
+    with long set, it's one per line with the size (or <dir>) first
+    """
+    row=""
+    for entry in os.ilistdir(location):
+        name=entry[0]
+        is_dir=entry[1]==0x4000
+        if is_dir:
+            name+="/"
+        if long:
+            if is_dir:
+                size="<dir>"
+            #newer MicroPython gives us the size, older needs a stat
+            elif len(entry)>3:
+                size=entry[3]
+            else:
+                size=os.stat(location.rstrip("/")+"/"+entry[0])[6]
+            yield f"{size:>8} {name}"
+            continue
+        #start a new line if this one won't fit
+        if row!="" and len(row)+len(name)>term_width:
+            yield row.rstrip()
+            row=""
+        row+=name+" "*(ls_column-len(name)%ls_column)
+    if row!="":
+        yield row.rstrip()
+
+def show_paged(rows):
+    """
+    send each line from rows, asking to continue every page_lines lines
+    returns False if the user stopped it early
+    """
+    for ii,row in enumerate(rows):
+        if ii>0 and ii%page_lines==0 and not pause_for_more():
+            return False
+        out_line(row)
+    return True
+
+def ls(location=".", long=False):
+    """
+    show a listing of a directory, several names to a line
+    long=True shows one per line with sizes, directories end in /
+    pauses every page_lines lines
+    """
+    try:
+        show_paged(ls_rows(location, long))
+    except OSError:
+        out_line(f"error: could not list '{location}'!")
+
+def decode_line(data):
+    """bytes to text for display, without choking on anything that isn't utf-8"""
+    try:
+        return data.decode("utf-8")
+    except UnicodeError:
+        return repr(data)[2:-1]
+
+def read_lines(fname, start=0):
+    """
+    generate the lines of a file (without line endings), from byte offset start
+    only reads file_chunk bytes at a time, so lines longer than that come out in pieces
+    """
+    with open(fname, "rb") as f:
+        if start>0:
+            f.seek(start)
+        pending=b""
+        cut=False #the last piece was cut off at file_chunk, not at a newline
+        while True:
+            chunk=f.read(file_chunk)
+            if not chunk:
+                break
+            pending+=chunk
+            #a newline straight after a cut just ends the line we already sent, it isn't an empty one
+            if cut:
+                if pending[:1]==b"\n":
+                    pending=pending[1:]
+                elif pending[:2]==b"\r\n":
+                    pending=pending[2:]
+            cut=False
+            while True:
+                end=pending.find(b"\n")
+                if end<0:
+                    break
+                yield decode_line(pending[:end].rstrip(b"\r"))
+                pending=pending[end+1:]
+            #no newline in sight, don't let it grow forever
+            if len(pending)>=file_chunk:
+                yield decode_line(pending.rstrip(b"\r"))
+                pending=b""
+                cut=True
+        if pending:
+            yield decode_line(pending.rstrip(b"\r"))
+
+def cat(fname):
+    """show a whole file, a page at a time"""
+    try:
+        show_paged(read_lines(fname))
+    except OSError:
+        out_line(f"error: could not read '{fname}'!")
+
+def head(fname, lines=10):
+    """show the first few lines of a file"""
+    def first(rows):
+        for ii,row in enumerate(rows):
+            if ii>=lines:
+                return
+            yield row
+    try:
+        show_paged(first(read_lines(fname)))
+    except OSError:
+        out_line(f"error: could not read '{fname}'!")
+
+def tail_start(fname, lines):
+    """byte offset where the last few lines of a file start, found by reading backwards from the end"""
+    with open(fname, "rb") as f:
+        pos=f.seek(0, 2)
+        if lines<=0:
+            return pos
+        #a newline right at the end doesn't start another line
+        if pos>0:
+            f.seek(pos-1)
+            if f.read(1)==b"\n":
+                pos-=1
+        found=0
+        while pos>0:
+            step=min(file_chunk, pos)
+            pos-=step
+            f.seek(pos)
+            chunk=f.read(step)
+            ii=len(chunk)
+            while True:
+                ii=chunk.rfind(b"\n", 0, ii)
+                if ii<0:
+                    break
+                found+=1
+                if found==lines:
+                    return pos+ii+1
+        return 0
+
+def tail(fname, lines=10):
+    """show the last few lines of a file, without reading the whole thing"""
+    try:
+        show_paged(read_lines(fname, tail_start(fname, lines)))
+    except OSError:
+        out_line(f"error: could not read '{fname}'!")
+
+def grep_lines(fname, text, ignore_case=False):
+    """
+    generate (line number, text to show) for each line of a file containing some text
+    only holds about file_chunk bytes of a line at once: a longer line is searched in pieces that
+    overlap by len(text)-1 bytes (so a match can't hide across a cut), and is reported once,
+    showing the piece the match was in
+    """
+    pattern=text.encode("utf-8")
+    if ignore_case:
+        pattern=pattern.lower()
+    keep=len(pattern)-1
+    def found(data):
+        return pattern in (data.lower() if ignore_case else data)
+    def shown(data, cut, more):
+        return ("..." if cut else "")+decode_line(data)+("..." if more else "")
+    with open(fname, "rb") as f:
+        num=1
+        pending=b""
+        cut=False #pending doesn't start at the start of the line
+        reported=False #this line has already been shown
+        while True:
+            chunk=f.read(file_chunk)
+            if not chunk:
+                break
+            pending+=chunk
+            while True:
+                end=pending.find(b"\n")
+                if end<0:
+                    break
+                row=pending[:end].rstrip(b"\r")
+                if not reported and found(row):
+                    yield num, shown(row, cut, False)
+                num+=1
+                pending=pending[end+1:]
+                cut=False
+                reported=False
+            #no newline in sight, search what we have and keep just enough to catch a match across the cut
+            if len(pending)>file_chunk:
+                if not reported and found(pending):
+                    yield num, shown(pending.rstrip(b"\r"), cut, True)
+                    reported=True
+                pending=pending[max(len(pending)-keep, 0):] if keep>0 else b""
+                cut=True
+        if not reported and len(pending)>0 and found(pending):
+            yield num, shown(pending.rstrip(b"\r"), cut, False)
+
+def grep(text, fname, ignore_case=False):
+    """show the lines of a file containing some text, with line numbers"""
+    def matches(rows):
+        for num,row in rows:
+            yield f"{num}: {row}"
+    try:
+        show_paged(matches(grep_lines(fname, text, ignore_case)))
+    except OSError:
+        out_line(f"error: could not read '{fname}'!")
+
+def full_path(fname):
+    """an absolute path with the . and .. bits worked out (MicroPython has no os.path to do this)"""
+    if not fname.startswith("/"):
+        fname=os.getcwd().rstrip("/")+"/"+fname
+    parts=[]
+    for part in fname.split("/"):
+        if part in ("", "."):
+            continue
+        if part=="..":
+            if parts:
+                parts.pop()
+            continue
+        parts.append(part)
+    return "/"+"/".join(parts)
+
+def same_file(a, b):
+    """whether two paths are the same file"""
+    if full_path(a)==full_path(b):
+        return True
+    try:
+        sa=os.stat(a)
+        sb=os.stat(b)
+    except OSError:
+        return False
+    #inode and device, when the filesystem has real ones (littlefs on the Pico doesn't)
+    return sa[1]!=0 and sa[1]==sb[1] and sa[2]==sb[2]
+
+def cp(src, dst):
+    """copy a file, file_chunk bytes at a time"""
+    #opening dst would empty src before we read it
+    if same_file(src, dst):
+        out_line(f"error: '{src}' and '{dst}' are the same file!")
+        return
+    buf=bytearray(file_chunk)
+    view=memoryview(buf)
+    total=0
+    started=False #whether dst has been opened (and emptied) yet
+    try:
+        fin=open(src, "rb")
+    except OSError:
+        out_line(f"error: could not read '{src}'!")
+        return
+    try:
+        with open(dst, "wb") as fout:
+            started=True
+            while True:
+                n=fin.readinto(buf)
+                if not n:
+                    break
+                fout.write(view[:n])
+                total+=n
+    except OSError:
+        out_line(f"error: could not copy '{src}' to '{dst}'!")
+        #don't leave half a file behind
+        if started:
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+        return
+    finally:
+        fin.close()
+    out_line(f"Copied {total} bytes.")
+
+def rm(fname):
+    """delete a file"""
+    try:
+        os.remove(fname)
+    except OSError:
+        out_line(f"error: could not remove '{fname}'!")
+        return
+    out_line(f"Removed '{fname}'.")
+
+mem_peak=0 #most memory seen in use (only checked now and then, so the real peak may be higher)
+gc_count=0 #garbage collections done by serial_repl itself
+
+def mem_sample():
+    """bytes currently in use, keeping track of the peak"""
+    global mem_peak
+    used=gc.mem_alloc()
+    if used>mem_peak:
+        mem_peak=used
+    return used
+
+def mem_collect():
+    """collect garbage, returns how many bytes it freed"""
+    global gc_count
+    used=mem_sample()
+    gc.collect()
+    gc_count+=1
+    return used-gc.mem_alloc()
+
+def mem_check():
+    """collect garbage if more than gc_ceiling bytes are in use"""
+    if gc_ceiling is not None and mem_sample()>gc_ceiling:
+        mem_collect()
+
+def mem_mark():
+    """snapshot of memory use, for mem_show_change()"""
+    return (mem_sample(), gc_count)
+
+def mem_show_change(before):
+    """
+    show how memory use changed since mem_mark()
+    MicroPython doesn't count its own collections, so if usage went down and we didn't collect, we just know it happened at least once
+    """
+    used=mem_sample()
+    collections=gc_count-before[1]
+    if collections==0 and used<before[0]:
+        collections=1
+    out_line(f"[mem: {used-before[0]:+} bytes, {gc.mem_free()} free, peak {mem_peak}, {collections} gc]")
+
+def mem(collect=False):
+    """
+    show memory use
+    collect=True collects garbage first, and shows how much that freed
+    """
+    if collect:
+        freed=mem_collect()
+    used=mem_sample()
+    free=gc.mem_free()
+    out_line(f"{used} bytes used, {free} free ({used*100//max(used+free, 1)}% used).")
+    out_line(f"Peak seen: {mem_peak} bytes. Collections by serial_repl: {gc_count}.")
+    if collect:
+        out_line(f"Collecting freed {freed} bytes.")
+    if gc_ceiling is not None:
+        out_line(f"Collecting at prompts above {gc_ceiling} bytes.")
+
+class Reboot(SystemExit):
+    """
+    raised by reboot() inside the raw REPL: machine.reset() never returns, so the
+    raw REPL has to send the host its D frame first, then reset
+    """
 
 def reboot():
     """restart the system"""
+    session=current()
+    if session.out_capture is not None:
+        raise Reboot()
+    session.flush()
     machine.reset()
 
 def bye():
     """exit this REPL system"""
+    session=current()
+    #the send thread has to go too, or the second core stays taken until a reset
+    session.stop_tx()
+    session.flush()
     sys.exit()
 
 def pause_for_more():
@@ -177,8 +998,7 @@ def pause_for_more():
     returns False if user enters text starting with q (like quit)
     otherwise, returns True
     """
-    result=in_line("Show more? (q to cancel)").strip().lower()
-    return not (result!="" and result[0]=="q")
+    return current().pause_for_more()
 
 def show_help():
     """display some commands and keys"""
@@ -187,7 +1007,10 @@ def show_help():
     out_line("Use load_and_patch('name') to load a program.")
     out_line("This will redefine print() and input() for them.")
     out_line("bye() will return to the USB REPL.")
-    out_line("ls() will show a dir listing.")
+    out_line("ls() will show a dir listing, ls('dir', True) shows sizes.")
+    out_line("cat(f), head(f), tail(f) and grep('text', f) show files.")
+    out_line("cp(src, dst) copies a file, rm(f) removes one.")
+    out_line("mem() shows memory use, mem_report=True shows it per line.")
     out_line("reboot() will restart the Pico.")
     out_line("Use out_line() instead of print() to write to the terminal.")
     out_line("Use in_line() instead of input() to read from the terminal.")
@@ -198,44 +1021,89 @@ def show_help():
     out_line("^H will backspace a character from the buffer.")
     out_line("^U will clear the input buffer.")
     out_line("^F will load the last submitted line to the buffer.")
+    out_line("^A on an empty line will enter the raw REPL (for host tools).")
+    out_line("^B will leave the raw REPL.")
+
+#raw REPL framing -- every frame is a kind byte, a big-endian u32 length, then that many bytes
+#host sends: E (exec the payload as source), B (leave the raw REPL)
+#device sends: R (banner, on entry), O (some output, utf-8), D (done: rest of stdout, result and exception fields), B (bye)
+#the fields of a D frame are each a u32 length followed by utf-8 text, an empty field means none
+#a lone ^B between frames also leaves, and any other stray byte between frames is skipped
+#E frames longer than raw_frame_max are refused with an error D frame, and the input is thrown away until it goes quiet
+raw_version="serial_repl raw v2"
+raw_kinds=(b"E", b"B") #kinds the host may send, anything else isn't the start of a frame
+
+def raw_field(s):
+    """pack a string as a length-prefixed field"""
+    data=s.encode("utf-8")
+    return struct.pack(">I", len(data))+data
+
+def raw_print(*args, **kwargs):
+    """print, except it's collected when called from code run by the raw REPL"""
+    if current().out_capture is not None and kwargs.get("file", sys.stdout)==sys.stdout:
+        out_line(*args, **kwargs)
+    else:
+        builtins.print(*args, **kwargs)
 
 def repl():
-    """main read-eval-print loop"""
-    #intro text, two newlines to skip past any garbage that may have been sent
-    out_nl()
-    out_nl()
-    out_line("Type show_help() to view help.")
-    out_line("^M will submit input.")
-    out_line("REPL ready.")
-    user_input=""
-    result=""
-    while True:
-        #read and evaluate input
-        try:
-            out_str(">>>")
-            user_input=in_line()
-            result=eval(user_input)
-            if result is not None:
-                out_line(result)
-        #we try to emit the result if we can, so we have to switch between eval and exec
-        #if exec returned a value, none of this would be needed
-        except SyntaxError:
-            try:
-                exec(user_input)
-            #real syntax error
-            except Exception as ex2:
-                out_line(ex2)
-        #could not parse
-        except Exception as ex:
-            out_line(ex)
+    """main read-eval-print loop on the calling session"""
+    current().repl()
+
+def start_session(uart, wait_period=None):
+    """
+    serve a REPL on another terminal, on a new thread (the second core, on the Pico)
+    returns the Session
+    the Pico only has the one spare core, so only one of these can run at a time there
+    the session gets its own copy of our globals to run code in: MicroPython on the RP2040 has no GIL,
+    so two cores writing to one dict would corrupt it
+    """
+    session=Session(uart, wait_period, dict(globals()))
+    _thread.start_new_thread(session.run, ())
+    return session
+
+def core1_users():
+    """the settings that want the second core -- there's only one, so only one of them can be on"""
+    users=[]
+    if tx_offload:
+        users.append("tx_offload")
+    if uart1_enable:
+        users.append("uart1_enable")
+    if usb_enable:
+        users.append("usb_enable")
+    return users
 
 def main():
     """run the main loop"""
-    time.sleep_ms(900) #the pico spews a bit of garbage, so we wait a bit
-    repl()
+    session0.drain_garbage()
+    users=core1_users()
+    if len(users)>1:
+        #starting a second thread on the Pico fails, so say why and carry on with just UART0
+        message=f"error: only one of {', '.join(users)} can have the second core! Only serving UART0."
+        builtins.print(message)
+        session0.out_line(message)
+    else:
+        if tx_offload:
+            session0.offload_tx()
+        if uart1_enable:
+            start_session(UART(1, baudrate=9600, tx=Pin(4), rx=Pin(5), rxbuf=uart_rxbuf))
+        if usb_enable:
+            #nothing to redraw on the USB side, so no need to pause after lines
+            start_session(StdioPort(), wait_period=0)
+    session0.run()
+
+def prefer_mpy():
+    """put mpy_dir at the front of the import path if it exists, so precompiled scripts win over .py ones"""
+    if mpy_dir in sys.path:
+        return
+    try:
+        os.stat(mpy_dir)
+    except OSError:
+        return
+    sys.path.insert(0, mpy_dir)
 
 def load_and_patch(s):
     """monkey-patch other scripts so they output over serial -- this is NOT robust at all"""
+    prefer_mpy()
     exec(f"import {s}\n{s}.input=in_line\n{s}.print=out_line")
 
 
@@ -0,0 +1,489 @@
+"""
+serial_repl_client.py -- host-side (CPython) client for the serial_repl.py raw REPL.
+(C) 2022 B.M.Deeal
+distributed under the ISC license, see <https://opensource.org/licenses/ISC> for details
+
+This talks to serial_repl.py running on a Pico, over a real serial port (using pyserial if it's
+installed) or a pty (see pico_sim.py). It switches the device to the raw REPL, so there's no
+echo, no prompt scraping and no line pacing, and keeps the port open between calls.
+
+    import serial_repl_client
+    with serial_repl_client.Connection("/dev/ttyUSB0") as pico:
+        print(pico.eval("1+1"))
+        print(pico.listdir("/"))
+        pico.put("notes.txt", "notes.txt")
+
+Requests can be pipelined with Connection.pipeline(), several Picos can be kept open at once
+with a Pool, and AsyncConnection/AsyncPool wrap both for asyncio.
+"""
+import os
+import sys
+import struct
+import time
+import select
+import threading
+import binascii
+import ast
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import serial #pyserial, optional -- without it we can still drive ptys and POSIX ttys
+except ImportError:
+    serial=None
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios=None
+
+raw_version_prefix=b"serial_repl raw v"
+chunk_size=512 #bytes per frame when moving files around
+
+class ReplError(Exception):
+    """base for everything that goes wrong talking to the device"""
+
+class ProtocolError(ReplError):
+    """the device sent something that doesn't make sense"""
+
+class OutOfStepError(ReplError):
+    """
+    an earlier request never got its answer (a timeout, say), so any reply still on its way
+    would be taken for the answer to the next one; enter_raw() (or a new Connection) starts afresh
+    """
+
+class RemoteError(ReplError):
+    """the code raised an exception on the device, result holds the full response"""
+    def __init__(self, result):
+        super().__init__(result.error)
+        self.result=result
+
+class Result:
+    """response to a single block of code: stdout, result (repr, or "" for None) and error text"""
+    def __init__(self, stdout="", result="", error=""):
+        self.stdout=stdout
+        self.result=result
+        self.error=error
+
+    def __repr__(self):
+        return f"Result(stdout={self.stdout!r}, result={self.result!r}, error={self.error!r})"
+
+    def value(self):
+        """the result as a Python value, raising RemoteError if the code failed"""
+        if self.error!="":
+            raise RemoteError(self)
+        if self.result=="":
+            return None
+        return ast.literal_eval(self.result)
+
+def pack_frame(kind, payload=b""):
+    """build a frame: kind byte, big-endian u32 length, payload"""
+    return struct.pack(">BI", kind[0], len(payload))+payload
+
+def unpack_fields(payload):
+    """split the payload of a D frame into its three strings"""
+    fields=[]
+    pos=0
+    for ii in range(3):
+        if pos+4>len(payload):
+            raise ProtocolError("truncated D frame")
+        size,=struct.unpack(">I", payload[pos:pos+4])
+        pos+=4
+        fields.append(payload[pos:pos+size].decode("utf-8", "replace"))
+        pos+=size
+    return Result(*fields)
+
+class FdPort:
+    """
+    minimal serial port on a raw file descriptor (a pty or a POSIX tty), used when pyserial isn't around
+    has the same read/write/close shape as the bits of serial.Serial we use
+    """
+    def __init__(self, path, baudrate=9600, timeout=5):
+        self.fd=os.open(path, os.O_RDWR|os.O_NOCTTY)
+        self.timeout=timeout
+        if termios is not None and os.isatty(self.fd):
+            tty.setraw(self.fd)
+            speed=getattr(termios, f"B{baudrate}", None)
+            if speed is not None:
+                attrs=termios.tcgetattr(self.fd)
+                attrs[4]=speed
+                attrs[5]=speed
+                termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+    def read(self, n):
+        """read up to n bytes, waiting at most timeout seconds for the first one"""
+        ready, _, _=select.select([self.fd], [], [], self.timeout)
+        if not ready:
+            return b""
+        return os.read(self.fd, n)
+
+    def write(self, data):
+        view=memoryview(data)
+        while len(view)>0:
+            view=view[os.write(self.fd, view):]
+        return len(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd=None
+
+def open_port(port, baudrate=9600, timeout=5):
+    """open a port by path, preferring pyserial when it's installed"""
+    if serial is not None:
+        return serial.Serial(port, baudrate=baudrate, timeout=timeout)
+    return FdPort(port, baudrate, timeout)
+
+class Connection:
+    """
+    one Pico running serial_repl.py, kept in the raw REPL until close()
+    port is a path, or anything with read(n)/write(data)/close() (like a serial.Serial)
+    timeout is how long to wait for the device before giving up, in seconds
+    window is how many requests may be in flight at once when pipelining, and window_bytes how
+    many bytes of them -- a byte that doesn't fit in the Pico's UART receive buffer (uart_rxbuf
+    in serial_repl.py) is lost, and the framing with it, so keep window_bytes well under that
+    (one request is always allowed, however big)
+    safe to share between threads, requests are done one at a time
+    """
+    def __init__(self, port, baudrate=9600, timeout=5, window=8, window_bytes=512):
+        owned=isinstance(port, str) #we opened it, so we close it if this goes wrong
+        if owned:
+            self.name=port
+            self.port=open_port(port, baudrate, timeout)
+        else:
+            self.name=repr(port)
+            self.port=port
+        self.timeout=timeout
+        self.window=window
+        self.window_bytes=window_bytes
+        self.buf=b""
+        self.lock=threading.RLock()
+        self.banner=None
+        self.left=False #the device stopped (bye(), reboot()), so it won't answer a B frame
+        self.broken=None #why replies can't be matched to requests any more, see OutOfStepError
+        try:
+            self.enter_raw()
+        except BaseException:
+            if owned:
+                self.port.close()
+            self.port=None
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_some(self, deadline):
+        """add whatever's available to the buffer, raising TimeoutError past the deadline"""
+        if time.monotonic()>deadline:
+            raise TimeoutError(f"{self.name}: no response from device")
+        data=self.port.read(4096)
+        if data:
+            self.buf+=data
+
+    def read_exact(self, n, deadline):
+        while len(self.buf)<n:
+            self.read_some(deadline)
+        data=self.buf[:n]
+        self.buf=self.buf[n:]
+        return data
+
+    def read_frame(self):
+        """read one frame, returns (kind, payload)"""
+        deadline=time.monotonic()+self.timeout
+        kind, size=struct.unpack(">BI", self.read_exact(5, deadline))
+        return bytes([kind]), self.read_exact(size, deadline)
+
+    def enter_raw(self):
+        """
+        get the device into the raw REPL from wherever it is
+        a B frame leaves the raw REPL if we were already in it (otherwise it's just a typed B),
+        ^U clears the line, and ^A on the now-empty line enters the raw REPL
+        """
+        with self.lock:
+            self.port.write(pack_frame(b"B")+b"\x15\x01")
+            #skip the human-readable noise until the banner frame shows up
+            deadline=time.monotonic()+self.timeout
+            while True:
+                pos=self.buf.find(raw_version_prefix)
+                if pos>=5 and self.buf[pos-5:pos-4]==b"R":
+                    size,=struct.unpack(">I", self.buf[pos-4:pos])
+                    if len(self.buf)>=pos+size:
+                        self.banner=self.buf[pos:pos+size].decode("utf-8")
+                        self.buf=self.buf[pos+size:]
+                        self.left=False
+                        self.broken=None
+                        return
+                self.read_some(deadline)
+
+    def check_in_step(self):
+        """raise OutOfStepError if an earlier request was left without its answer"""
+        if self.broken is not None:
+            raise OutOfStepError(f"{self.name}: out of step after {self.broken}, call enter_raw() or reconnect")
+
+    def send(self, src):
+        """queue up a block of code without waiting for the answer, returns the frame size in bytes"""
+        self.check_in_step()
+        data=pack_frame(b"E", src.encode("utf-8"))
+        self.port.write(data)
+        return len(data)
+
+    def recv(self):
+        """wait for the answer to the oldest block sent, gathering up any O frames of output on the way"""
+        self.check_in_step()
+        try:
+            return self.recv_result()
+        except BaseException as ex:
+            #whatever the device sends next could be the answer we just gave up on
+            self.broken=f"{type(ex).__name__}: {ex}"
+            raise
+
+    def recv_result(self):
+        """the guts of recv()"""
+        output=[]
+        while True:
+            kind, payload=self.read_frame()
+            if kind!=b"O":
+                break
+            output.append(payload)
+        if kind!=b"D":
+            raise ProtocolError(f"{self.name}: expected a D frame, got {kind!r}")
+        result=unpack_fields(payload)
+        result.stdout=b"".join(output).decode("utf-8", "replace")+result.stdout
+        #bye() ends serial_repl, and after a Reboot the device resets once it has answered
+        if result.error.split(":")[0] in ("SystemExit", "Reboot"):
+            self.left=True
+        return result
+
+    def exec(self, src):
+        """run a block of code, returns a Result (exceptions on the device are in result.error)"""
+        return self.pipeline([src])[0]
+
+    def eval(self, src):
+        """run an expression and return its value, raising RemoteError if it failed"""
+        return self.exec(src).value()
+
+    def pipeline(self, sources, check=False, window=None):
+        """
+        run several blocks of code, returns a list of Results in the same order
+        keeps up to window requests (and window_bytes bytes) in flight instead of waiting on each one
+        window overrides the connection's setting, 1 waits for each answer before sending the next
+        with check set, raises RemoteError for the first failure (after everything has run)
+        """
+        if window is None:
+            window=self.window
+        results=[]
+        with self.lock:
+            self.check_in_step()
+            sent=0
+            in_flight=[] #frame sizes of the requests not answered yet
+            try:
+                for src in sources:
+                    size=len(src.encode("utf-8"))+5
+                    while len(in_flight)>0 and (len(in_flight)>=window or sum(in_flight)+size>self.window_bytes):
+                        results.append(self.recv())
+                        in_flight.pop(0)
+                    in_flight.append(self.send(src))
+                    sent+=1
+                while len(results)<sent:
+                    results.append(self.recv())
+            except BaseException as ex:
+                #requests still in flight will be answered later, and mixed up with the next ones
+                if self.broken is None and len(results)<sent:
+                    self.broken=f"{type(ex).__name__}: {ex}"
+                raise
+        if check:
+            for result in results:
+                if result.error!="":
+                    raise RemoteError(result)
+        return results
+
+    def listdir(self, path="."):
+        """list a directory on the device"""
+        return self.eval(f"__import__('os').listdir({path!r})")
+
+    def put(self, local, remote):
+        """copy a local file onto the device, returns the number of bytes sent"""
+        with open(local, "rb") as f:
+            data=f.read()
+        return self.put_bytes(data, remote)
+
+    def put_bytes(self, data, remote):
+        """write some bytes to a file on the device"""
+        sources=[f"_src_f=open({remote!r},'wb')", "_src_a2b=__import__('binascii').a2b_base64"]
+        for pos in range(0, len(data), chunk_size):
+            chunk=binascii.b2a_base64(data[pos:pos+chunk_size], newline=False)
+            sources.append(f"_src_f.write(_src_a2b({chunk!r}))")
+        sources.append("_src_f.close()")
+        #flash writes on the Pico run with interrupts off, so anything arriving meanwhile can be lost;
+        #send each chunk only once the last one is written
+        self.pipeline(sources, check=True, window=1)
+        return len(data)
+
+    def get(self, remote, local):
+        """copy a file from the device to a local file, returns the number of bytes"""
+        data=self.get_bytes(remote)
+        with open(local, "wb") as f:
+            f.write(data)
+        return len(data)
+
+    def get_bytes(self, remote):
+        """read a file on the device"""
+        with self.lock:
+            size=self.eval(f"__import__('os').stat({remote!r})[6]")
+            sources=[f"_src_f=open({remote!r},'rb')", "_src_b2a=__import__('binascii').b2a_base64"]
+            count=(size+chunk_size-1)//chunk_size
+            sources+=[f"_src_b2a(_src_f.read({chunk_size}))"]*count
+            sources.append("_src_f.close()")
+            results=self.pipeline(sources, check=True)
+        return b"".join(binascii.a2b_base64(r.value()) for r in results[2:2+count])
+
+    def close(self):
+        """put the device back in the normal REPL and close the port"""
+        with self.lock:
+            if self.port is None:
+                return
+            try:
+                if not self.left:
+                    self.port.write(pack_frame(b"B"))
+                    while self.read_frame()[0]!=b"B":
+                        pass
+            except (ReplError, TimeoutError, OSError):
+                pass
+            self.port.close()
+            self.port=None
+
+class Pool:
+    """
+    keeps a Connection open per port, so repeated calls don't pay for reopening
+    run() does the same thing on several Picos at once, one thread each
+    """
+    def __init__(self, baudrate=9600, timeout=5, window=8, window_bytes=512):
+        self.options={"baudrate": baudrate, "timeout": timeout, "window": window, "window_bytes": window_bytes}
+        self.connections={}
+        self.opening={} #port -> lock held while that port is being opened
+        self.lock=threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, port):
+        """
+        the open connection for port, opening it on first use
+        a slow (or dead) port only holds up callers waiting for that same port
+        """
+        with self.lock:
+            if port in self.connections:
+                return self.connections[port]
+            opening=self.opening.setdefault(port, threading.Lock())
+        with opening:
+            with self.lock:
+                if port in self.connections:
+                    return self.connections[port]
+            conn=Connection(port, **self.options)
+            with self.lock:
+                self.connections[port]=conn
+            return conn
+
+    def run(self, ports, fn):
+        """call fn(connection) for each port in parallel, returns {port: result}"""
+        ports=list(ports)
+        if len(ports)==0:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(ports)) as ex:
+            futures={port: ex.submit(lambda p: fn(self.get(p)), port) for port in ports}
+            return {port: f.result() for port, f in futures.items()}
+
+    def exec_all(self, ports, src):
+        """run the same block of code on several Picos, returns {port: Result}"""
+        return self.run(ports, lambda conn: conn.exec(src))
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections={}
+            self.opening={}
+
+class AsyncConnection:
+    """
+    asyncio wrapper for Connection; the blocking I/O runs in a worker thread
+    create with: pico=await AsyncConnection.open(port)
+    """
+    def __init__(self, conn):
+        self.conn=conn
+
+    @classmethod
+    async def open(cls, port, **kwargs):
+        return cls(await asyncio.to_thread(Connection, port, **kwargs))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def exec(self, src):
+        return await asyncio.to_thread(self.conn.exec, src)
+
+    async def eval(self, src):
+        return await asyncio.to_thread(self.conn.eval, src)
+
+    async def pipeline(self, sources, check=False):
+        return await asyncio.to_thread(self.conn.pipeline, list(sources), check)
+
+    async def listdir(self, path="."):
+        return await asyncio.to_thread(self.conn.listdir, path)
+
+    async def put(self, local, remote):
+        return await asyncio.to_thread(self.conn.put, local, remote)
+
+    async def get(self, remote, local):
+        return await asyncio.to_thread(self.conn.get, remote, local)
+
+    async def close(self):
+        await asyncio.to_thread(self.conn.close)
+
+class AsyncPool:
+    """asyncio version of Pool"""
+    def __init__(self, **kwargs):
+        self.pool=Pool(**kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get(self, port):
+        return AsyncConnection(await asyncio.to_thread(self.pool.get, port))
+
+    async def exec_all(self, ports, src):
+        """run the same block of code on several Picos concurrently, returns {port: Result}"""
+        ports=list(ports)
+        conns=[await self.get(port) for port in ports]
+        results=await asyncio.gather(*(conn.exec(src) for conn in conns))
+        return dict(zip(ports, results))
+
+    async def close(self):
+        await asyncio.to_thread(self.pool.close)
+
+if __name__=="__main__":
+    #quick command line use: python serial_repl_client.py PORT 'code'
+    if len(sys.argv)<3:
+        print("usage: serial_repl_client.py PORT CODE")
+        sys.exit(1)
+    with Connection(sys.argv[1]) as pico:
+        result=pico.exec(sys.argv[2])
+        sys.stdout.write(result.stdout)
+        if result.result!="":
+            print(result.result)
+        if result.error!="":
+            print(result.error, file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,508 @@
+"""
+test_serial_repl.py -- device-side tests for serial_repl.py, on pico_sim's memory-backed UARTs.
+(C) 2022 B.M.Deeal
+distributed under the ISC license, see <https://opensource.org/licenses/ISC> for details
+
+Each test gets a fresh copy of serial_repl with simulated time, so line pauses cost nothing and
+timings are exact. Input is scripted: once the device has read all of it, pico_sim stops it.
+Run with: python -m pytest -q
+"""
+import sys
+import time
+import struct
+import threading
+import pytest
+import pico_sim
+
+@pytest.fixture
+def sim(tmp_path, monkeypatch):
+    """simulated time, in an empty directory; real time is put back afterwards"""
+    monkeypatch.chdir(tmp_path)
+    clock=pico_sim.Clock()
+    pico_sim.install(clock)
+    yield clock
+    pico_sim.install()
+
+@pytest.fixture
+def repl(sim):
+    """a fresh serial_repl, UART0 in memory"""
+    return pico_sim.load("serial_repl", alias="serial_repl_test")
+
+@pytest.fixture
+def live(tmp_path, monkeypatch):
+    """a fresh serial_repl in real time, for tests with real threads; UART0 in memory"""
+    monkeypatch.chdir(tmp_path)
+    pico_sim.install()
+    repl=pico_sim.load("serial_repl", alias="serial_repl_test")
+    repl.wait_period=0
+    return repl
+
+def run(fn, *args):
+    """call a device loop until it runs out of input"""
+    try:
+        fn(*args)
+    except pico_sim.Stop:
+        pass
+
+def frame(kind, payload=b""):
+    if isinstance(payload, str):
+        payload=payload.encode("utf-8")
+    return struct.pack(">BI", kind[0], len(payload))+payload
+
+def read_frames(data):
+    """split what the device sent into (kind, payload) pairs"""
+    frames=[]
+    pos=0
+    while pos<len(data):
+        kind, size=struct.unpack(">BI", data[pos:pos+5])
+        frames.append((bytes([kind]), data[pos+5:pos+5+size]))
+        pos+=5+size
+    return frames
+
+def fields(payload):
+    """the three strings in a D frame"""
+    out=[]
+    pos=0
+    for ii in range(3):
+        size,=struct.unpack(">I", payload[pos:pos+4])
+        out.append(payload[pos+4:pos+4+size].decode("utf-8"))
+        pos+=4+size
+    return out
+
+def run_raw(repl, *sources):
+    """run some blocks of code through the raw REPL, returns the frames sent back after the banner"""
+    uart=repl.session0.uart
+    uart.feed(b"".join(frame(b"E", src) for src in sources))
+    run(repl.session0.raw_repl)
+    frames=read_frames(uart.take())
+    assert frames[0]==(b"R", repl.raw_version.encode("utf-8"))
+    return frames[1:]
+
+def test_raw_exec(repl):
+    frames=run_raw(repl, "1+2", "x=4", "out_line('x is', x)", "1/0")
+    assert [kind for kind, payload in frames]==[b"D"]*4
+    assert fields(frames[0][1])==["", "3", ""]
+    assert fields(frames[1][1])==["", "", ""]
+    assert fields(frames[2][1])==["x is 4\r\n", "", ""]
+    assert fields(frames[3][1])[2].startswith("ZeroDivisionError")
+
+def test_raw_output_streamed(repl, sim):
+    #a big file has to go out as it's read, not be gathered up for the D frame
+    with open("big.txt", "w") as f:
+        for ii in range(300):
+            f.write(f"line {ii:03} of a log file\n")
+    frames=run_raw(repl, "cat('big.txt')")
+    kinds=[kind for kind, payload in frames]
+    assert kinds[-1]==b"D"
+    assert set(kinds[:-1])=={b"O"}
+    assert len(kinds)>10
+    for kind, payload in frames[:-1]:
+        assert len(payload)<repl.raw_out_chunk+32
+    stdout=fields(frames[-1][1])[0]
+    assert len(stdout)<repl.raw_out_chunk
+    text=b"".join(payload for kind, payload in frames[:-1]).decode("utf-8")+stdout
+    assert text.splitlines()==[f"line {ii:03} of a log file" for ii in range(300)]
+
+def test_raw_frame_too_long(repl):
+    uart=repl.session0.uart
+    uart.feed(struct.pack(">BI", ord("E"), 10**9)+b"garbage")
+    run(repl.session0.raw_repl)
+    frames=read_frames(uart.take())
+    assert frames[1][0]==b"D"
+    assert "longer than" in fields(frames[1][1])[2]
+    #the rest was thrown away, not kept waiting for a gigabyte that isn't coming
+    assert repl.session0.in_pending==b""
+
+def test_raw_leave(repl):
+    uart=repl.session0.uart
+    #stray bytes are skipped, a B frame leaves
+    uart.feed(b"\x00\xff"+frame(b"E", "2*3")+frame(b"B"))
+    repl.session0.raw_repl()
+    frames=read_frames(uart.take())
+    assert [kind for kind, payload in frames]==[b"R", b"D", b"B"]
+    #and so does a lone ^B, for a person at a terminal
+    uart.feed(b"\x02")
+    repl.session0.raw_repl()
+    assert uart.take().endswith(b"...left raw REPL\r\n")
+
+def test_raw_reboot_answers_first(repl):
+    #machine.reset() never returns on a Pico, so the D frame has to be out before it's called
+    uart=repl.session0.uart
+    uart.feed(frame(b"E", "reboot()"))
+    with pytest.raises(pico_sim.Reset):
+        repl.session0.raw_repl()
+    frames=read_frames(uart.take())
+    assert frames[-1][0]==b"D"
+    assert fields(frames[-1][1])[2].startswith("Reboot")
+
+def test_raw_bye_answers_first(repl):
+    uart=repl.session0.uart
+    uart.feed(frame(b"E", "bye()"))
+    with pytest.raises(SystemExit):
+        repl.session0.raw_repl()
+    frames=read_frames(uart.take())
+    assert fields(frames[-1][1])[2].startswith("SystemExit")
+
+def test_uart_rxbuf(repl):
+    #the rp2 default of 256 bytes is less than one put_bytes() frame
+    assert repl.open_uart0().rxbuf==repl.uart_rxbuf
+    assert repl.uart_rxbuf>=1024
+
+def test_two_sessions(tmp_path, monkeypatch):
+    #both UARTs of one fake Pico, UART1 on its own thread like core 1
+    import serial_repl_client
+    monkeypatch.chdir(tmp_path)
+    ports=pico_sim.serve_pty_pair()
+    with serial_repl_client.Pool(timeout=5) as pool:
+        uart0=pool.get(ports[0])
+        uart1=pool.get(ports[1])
+        #each has its own variables, so the cores never write to the same dict...
+        uart0.exec("shared=1")
+        result=uart1.exec("shared")
+        assert result.error.startswith("NameError")
+        uart1.exec("shared=2")
+        assert uart0.eval("shared")==1
+        #...but both start out with everything serial_repl has
+        assert uart1.eval("page_lines")==uart0.eval("page_lines")
+        #and output goes to whoever asked, print included
+        results=pool.exec_all(ports, "out_line('hi'); print('there')")
+        assert all(r.stdout.splitlines()==["hi", "there"] for r in results.values())
+
+def test_raw_print_restored(repl):
+    #print is only pointed at raw_print while raw code runs, in that session's own namespace
+    names=vars(repl)
+    run_raw(repl, "print('x')")
+    assert "print" not in names
+    names["print"]=repl.out_line
+    run_raw(repl, "print('x')")
+    assert names["print"] is repl.out_line
+    session=repl.Session(names={})
+    session.raw_exec("print('x')")
+    assert "print" not in session.names
+    #...and doesn't touch anyone else's
+    assert names["print"] is repl.out_line
+
+class Recorder:
+    """a port that remembers what was written and when, and can be held up to play a slow terminal"""
+    def __init__(self):
+        self.writes=[]
+        self.gate=threading.Event()
+        self.gate.set()
+
+    def write(self, data):
+        self.gate.wait()
+        self.writes.append((time.monotonic(), data))
+
+    def text(self):
+        return "".join(data for when, data in self.writes)
+
+def start_worker(queue):
+    thread=threading.Thread(target=queue.run, daemon=True)
+    thread.start()
+    return thread
+
+def test_tx_queue_backpressure(live):
+    port=Recorder()
+    queue=live.TxQueue(port, size=8)
+    start_worker(queue)
+    port.gate.clear()
+    writer=threading.Thread(target=lambda: [queue.write("abcd") for ii in range(5)], daemon=True)
+    writer.start()
+    time.sleep(0.1)
+    #one write stuck in the port, one waiting in the queue, the writer waiting for room
+    assert writer.is_alive()
+    assert queue.queued==8
+    port.gate.set()
+    writer.join(1)
+    queue.flush()
+    assert port.text()=="abcd"*5
+    assert queue.queued==0
+    queue.stop()
+
+def test_tx_queue_pause_order(live):
+    port=Recorder()
+    queue=live.TxQueue(port)
+    start_worker(queue)
+    queue.write("a")
+    queue.pause(100)
+    queue.write("b")
+    #the writer doesn't wait for the pause, the worker does
+    queue.flush()
+    (first, a), (second, b)=port.writes
+    assert (a, b)==("a", "b")
+    assert second-first>=0.09
+    queue.stop()
+
+def test_tx_queue_stop(live):
+    port=Recorder()
+    queue=live.TxQueue(port)
+    thread=start_worker(queue)
+    for ii in range(20):
+        queue.write(f"{ii},")
+    queue.stop()
+    #everything went out, and the worker (and so the core) is free
+    assert port.text()=="".join(f"{ii}," for ii in range(20))
+    assert queue.done
+    thread.join(1)
+    assert not thread.is_alive()
+
+def test_bye_stops_tx_offload(live):
+    session=live.session0
+    session.offload_tx()
+    queue=session.tx
+    session.out_line("goodbye")
+    with pytest.raises(SystemExit):
+        live.bye()
+    assert session.tx is None
+    assert queue.done
+    assert session.uart.take()==b"goodbye\r\n"
+    #so a second main() in the same boot could have the core back
+    session.offload_tx()
+    session.out_line("again")
+    session.stop_tx()
+    assert session.uart.take()==b"again\r\n"
+
+def make_files(path, names):
+    path.mkdir()
+    for name in names:
+        (path/name).write_text(name)
+
+def test_ls_columns(repl, tmp_path):
+    names=[f"f{ii}" for ii in range(30)]+["a_rather_long_file_name.txt"]
+    make_files(tmp_path/"d", names)
+    repl.term_width=40
+    repl.ls_column=10
+    rows=list(repl.ls_rows("d"))
+    #packed into columns, none past the edge
+    assert len(rows)<len(names)/3
+    assert all(len(row)<=40 for row in rows)
+    assert sorted(" ".join(rows).split())==sorted(names)
+    for row in rows:
+        for name in row.split():
+            if len(name)<10:
+                assert row.index(name)%10==0
+
+def test_ls_long(repl, tmp_path):
+    make_files(tmp_path/"d", ["abc", "hello.txt"])
+    (tmp_path/"d"/"sub").mkdir()
+    rows=sorted(repl.ls_rows("d", long=True), key=lambda row: row.split()[-1])
+    assert rows==["       3 abc", "       9 hello.txt", "   <dir> sub/"]
+
+def test_ls_pages(repl, tmp_path):
+    make_files(tmp_path/"d", [f"f{ii:02}" for ii in range(12)])
+    repl.page_lines=5
+    uart=repl.session0.uart
+    #carry on after the first page, quit after the second
+    uart.feed(b"\rq\r")
+    repl.ls("d", True)
+    text=uart.take().decode("ascii")
+    assert text.count("Show more?")==2
+    assert sum(1 for row in text.split("\r\n") if row.startswith("       3 f"))==10
+
+def test_ls_raw_no_paging(repl, tmp_path):
+    #a host can't answer "Show more?", so the raw REPL gets the lot
+    make_files(tmp_path/"many", [f"f{ii:03}.txt" for ii in range(100)])
+    frames=run_raw(repl, "ls('many', True)")
+    text=b"".join(payload for kind, payload in frames[:-1]).decode("utf-8")+fields(frames[-1][1])[0]
+    assert "Show more?" not in text
+    assert sum(1 for row in text.splitlines() if row.endswith(".txt"))==100
+
+def shown(repl, code):
+    """run a line of code on the device, returns the lines it sent"""
+    uart=repl.session0.uart
+    uart.take()
+    eval(code, vars(repl))
+    return uart.take().decode("utf-8").split("\r\n")[:-1]
+
+def test_cat_long_lines(repl, tmp_path):
+    repl.file_chunk=4
+    (tmp_path/"a.txt").write_bytes(b"a"*20+b"\nx\n")
+    #cut into pieces, but no empty line after the last one
+    assert shown(repl, "cat('a.txt')")==["aaaa"]*5+["x"]
+    (tmp_path/"b.txt").write_bytes(b"b"*8+b"\r\nend\r\n")
+    assert shown(repl, "cat('b.txt')")==["bbbb", "bbbb", "end"]
+    (tmp_path/"c.txt").write_bytes(b"c"*6+b"\n\nz")
+    assert shown(repl, "cat('c.txt')")==["cccc", "cc", "", "z"]
+
+def test_cat_pages(repl, tmp_path):
+    (tmp_path/"a.txt").write_text("".join(f"line {ii}\n" for ii in range(12)))
+    repl.page_lines=5
+    repl.session0.uart.feed(b"\rq\r")
+    rows=shown(repl, "cat('a.txt')")
+    assert [row for row in rows if row.startswith("line")]==[f"line {ii}" for ii in range(10)]
+
+def test_head_tail(repl, tmp_path):
+    (tmp_path/"a.txt").write_text("one\ntwo\nthree\n")
+    assert shown(repl, "head('a.txt', 2)")==["one", "two"]
+    assert shown(repl, "tail('a.txt', 2)")==["two", "three"]
+    assert shown(repl, "tail('a.txt', 10)")==["one", "two", "three"]
+    assert shown(repl, "tail('a.txt', 0)")==[]
+    assert shown(repl, "tail('nope.txt')")==["error: could not read 'nope.txt'!"]
+    #reading backwards a few bytes at a time finds the same lines
+    (tmp_path/"b.txt").write_text("a\nb\nc\nd\n")
+    repl.file_chunk=2
+    assert shown(repl, "tail('b.txt', 3)")==["b", "c", "d"]
+
+def test_grep_line_numbers(repl, tmp_path):
+    (tmp_path/"a.txt").write_text("abcdefghij\nxy\nABC\n")
+    repl.file_chunk=4
+    #a long line is one line, even in pieces, and a match across a cut is still found
+    assert shown(repl, "grep('efg', 'a.txt')")[0].startswith("1: ")
+    assert shown(repl, "grep('abcdefghij', 'a.txt')")[0].startswith("1: ")
+    assert shown(repl, "grep('xy', 'a.txt')")==["2: xy"]
+    assert [row[:2] for row in shown(repl, "grep('abc', 'a.txt', True)")]==["1:", "3:"]
+    assert shown(repl, "grep('zz', 'a.txt')")==[]
+
+def test_cp_rm(repl, tmp_path):
+    (tmp_path/"a.txt").write_text("hello")
+    assert shown(repl, "cp('a.txt', 'b.txt')")==["Copied 5 bytes."]
+    assert (tmp_path/"b.txt").read_text()=="hello"
+    #copying onto itself would empty it
+    assert "same file" in shown(repl, "cp('a.txt', './a.txt')")[0]
+    assert "same file" in shown(repl, f"cp('a.txt', '{tmp_path}/a.txt')")[0]
+    assert (tmp_path/"a.txt").read_text()=="hello"
+    assert shown(repl, "cp('nope.txt', 'c.txt')")==["error: could not read 'nope.txt'!"]
+    assert not (tmp_path/"c.txt").exists()
+    assert shown(repl, "rm('b.txt')")==["Removed 'b.txt'."]
+    assert not (tmp_path/"b.txt").exists()
+
+class Noisy:
+    """a line that never stops spewing garbage"""
+    def any(self):
+        return 1
+
+    def read(self):
+        return b"\x00"
+
+def test_lazy_hardware(sim):
+    repl=pico_sim.load("serial_repl", alias="serial_repl_test")
+    #nothing is set up just by importing
+    assert repl.uart0 is None
+    assert repl.led is None
+    assert repl.session0.uart is repl.uart0
+    repl.set_led_on()
+    assert repl.led.value()==1
+
+def test_drain_garbage_quiet(repl, sim):
+    uart=repl.session0.uart
+    uart.feed(b"\x00\xff\x00", scripted=False)
+    start=sim.ms
+    repl.session0.drain_garbage()
+    #the garbage is gone, and we waited about garbage_quiet_ms after it, no more
+    assert uart.any()==0
+    assert repl.garbage_quiet_ms<=sim.ms-start<=repl.garbage_quiet_ms+2
+
+def test_drain_garbage_max_wait(repl, sim):
+    start=sim.ms
+    repl.Session(Noisy()).drain_garbage()
+    #never quiet, so it gives up after garbage_wait_max
+    assert repl.garbage_wait_max<=sim.ms-start<=repl.garbage_wait_max+2
+
+def test_startup_banner(repl, sim):
+    uart=repl.session0.uart
+    uart.feed(b"\x00\xfe", scripted=False)
+    uart.stop_after("REPL ready.")
+    run(repl.main)
+    text=uart.take()
+    assert b"\x00" not in text
+    assert text.endswith(b"REPL ready.")
+    #the old fixed pause was 900ms, now it's the quiet time plus sending the banner
+    assert sim.ms<repl.garbage_wait_max
+
+def test_prefer_mpy(repl, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    repl.mpy_dir=str(tmp_path/"mpy")
+    repl.prefer_mpy()
+    assert repl.mpy_dir not in sys.path
+    (tmp_path/"mpy").mkdir()
+    repl.prefer_mpy()
+    repl.prefer_mpy()
+    assert sys.path[0]==repl.mpy_dir
+    assert sys.path.count(repl.mpy_dir)==1
+
+class Heap:
+    """stands in for the gc module, with a heap the test controls"""
+    def __init__(self):
+        self.used=1000
+        self.garbage=0 #how much of used a collection would free
+        self.collections=0
+
+    def mem_alloc(self):
+        return self.used
+
+    def mem_free(self):
+        return 10000-self.used
+
+    def collect(self):
+        self.collections+=1
+        self.used-=self.garbage
+        self.garbage=0
+
+@pytest.fixture
+def heap(repl, monkeypatch):
+    heap=Heap()
+    monkeypatch.setattr(repl, "gc", heap)
+    return heap
+
+def test_mem_show_change(repl, heap):
+    before=repl.mem_mark()
+    heap.used=1500
+    assert shown(repl, f"mem_show_change({before!r})")==["[mem: +500 bytes, 8500 free, peak 1500, 0 gc]"]
+    #usage went down without us collecting, so MicroPython must have, at least once
+    before=repl.mem_mark()
+    heap.used=1200
+    assert shown(repl, f"mem_show_change({before!r})")==["[mem: -300 bytes, 8800 free, peak 1500, 1 gc]"]
+    #our own collections are counted exactly
+    before=repl.mem_mark()
+    heap.garbage=200
+    repl.mem_collect()
+    repl.mem_collect()
+    assert shown(repl, f"mem_show_change({before!r})")==["[mem: -200 bytes, 9000 free, peak 1500, 2 gc]"]
+
+def test_mem(repl, heap):
+    heap.used=2500
+    heap.garbage=500
+    repl.gc_ceiling=3000
+    assert shown(repl, "mem(True)")==[
+        "2000 bytes used, 8000 free (20% used).",
+        "Peak seen: 2500 bytes. Collections by serial_repl: 1.",
+        "Collecting freed 500 bytes.",
+        "Collecting at prompts above 3000 bytes.",
+    ]
+
+def test_gc_ceiling(repl, heap):
+    uart=repl.session0.uart
+    uart.feed(b"a\rb\rc\r")
+    repl.in_line()
+    #off by default
+    assert heap.collections==0
+    repl.gc_ceiling=2000
+    heap.used=1500
+    repl.in_line()
+    assert heap.collections==0
+    #over the ceiling at a prompt, so collect before waiting for input
+    heap.used=2500
+    heap.garbage=1000
+    repl.in_line()
+    assert heap.collections==1
+    assert repl.gc_count==1
+    assert heap.used==1500
+
+def test_mem_report(repl, heap):
+    repl.mem_report=True
+    uart=repl.session0.uart
+    uart.feed(b"x=1\r")
+    run(repl.repl)
+    assert b"\r\n[mem: +0 bytes, 9000 free, peak 1000, 0 gc]\r\n" in uart.take()
+
+def test_mem_traced(repl):
+    #pico_sim only has numbers once tracing is on
+    pico_sim.trace_memory()
+    try:
+        before=repl.mem_sample()
+        junk=[bytearray(1000) for ii in range(50)]
+        assert repl.mem_sample()>=before+50000
+        assert repl.mem_peak>=before+50000
+        del junk
+    finally:
+        pico_sim.trace_memory(False)
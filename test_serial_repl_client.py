@@ -0,0 +1,234 @@
+"""
+test_serial_repl_client.py -- drive serial_repl_client against fake Picos from pico_sim.
+(C) 2022 B.M.Deeal
+distributed under the ISC license, see <https://opensource.org/licenses/ISC> for details
+
+Each test gets fresh serial_repl copies on ptys, so the whole raw REPL path (framing, capture,
+errors, leaving) is exercised without hardware. Run with: python -m pytest -q
+"""
+import os
+import time
+import threading
+import asyncio
+import pytest
+import pico_sim
+import serial_repl_client
+
+timeout=5 #seconds, plenty for a pty
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    """run in an empty directory, which the fake Picos share as their filesystem"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def pico(scratch):
+    """a connection to a fresh fake Pico"""
+    conn=serial_repl_client.Connection(pico_sim.serve_pty(), timeout=timeout)
+    yield conn
+    conn.close()
+
+def test_banner(pico):
+    assert pico.banner.startswith("serial_repl raw v")
+
+def test_eval_and_exec(pico):
+    assert pico.eval("1+2")==3
+    assert pico.eval("x=5") is None
+    assert pico.eval("[x, 'a', None]")==[5, "a", None]
+    result=pico.exec("out_line('hello', x)")
+    assert result.stdout.splitlines()==["hello 5"]
+    assert result.error==""
+    result=pico.exec("print('plain', 'print')")
+    assert result.stdout.splitlines()==["plain print"]
+
+def test_remote_error(pico):
+    result=pico.exec("1/0")
+    assert result.error.startswith("ZeroDivisionError")
+    with pytest.raises(serial_repl_client.RemoteError) as info:
+        pico.eval("undefined_name")
+    assert info.value.result.error.startswith("NameError")
+    result=pico.exec("def f(:")
+    assert result.error.startswith("SyntaxError")
+    #still usable afterwards
+    assert pico.eval("2*21")==42
+
+def test_timeout_leaves_connection_out_of_step(scratch):
+    conn=serial_repl_client.Connection(pico_sim.serve_pty(), timeout=1)
+    try:
+        with pytest.raises(TimeoutError):
+            conn.exec("time.sleep(1.5); 'slow'")
+        #the slow reply is still coming, so it mustn't be taken for this one's
+        with pytest.raises(serial_repl_client.OutOfStepError):
+            conn.eval("1+1")
+        with pytest.raises(serial_repl_client.OutOfStepError):
+            conn.pipeline(["2+2"])
+        #starting afresh throws the stale reply away
+        conn.enter_raw()
+        assert conn.eval("1+1")==2
+        assert conn.eval("2+2")==4
+    finally:
+        conn.close()
+
+def test_pipeline(scratch):
+    conn=serial_repl_client.Connection(pico_sim.serve_pty(), timeout=timeout, window=3)
+    try:
+        results=conn.pipeline([f"{ii}*{ii}" for ii in range(20)])
+        assert [r.value() for r in results]==[ii*ii for ii in range(20)]
+        results=conn.pipeline(["a=1", "1/0", "a+1"])
+        assert results[1].error.startswith("ZeroDivisionError")
+        #the rest still ran
+        assert results[2].value()==2
+        with pytest.raises(serial_repl_client.RemoteError):
+            conn.pipeline(["b=1", "1/0", "b=2"], check=True)
+        assert conn.eval("b")==2
+    finally:
+        conn.close()
+
+def test_long_output(pico, scratch):
+    #far more than one O frame's worth, which recv() has to stitch back together
+    (scratch/"big.txt").write_text("".join(f"line {ii:03} of a log file\n" for ii in range(300)))
+    result=pico.exec("cat('big.txt')")
+    assert result.error==""
+    assert result.stdout.splitlines()==[f"line {ii:03} of a log file" for ii in range(300)]
+    assert pico.eval("'after'")=="after"
+
+class Tracking(serial_repl_client.Connection):
+    """a Connection that remembers the most requests (and bytes of them) it ever had waiting for an answer"""
+    def __init__(self, *args, **kwargs):
+        self.waiting=[]
+        self.most_frames=0
+        self.most_bytes=0
+        super().__init__(*args, **kwargs)
+
+    def send(self, src):
+        size=super().send(src)
+        self.waiting.append(size)
+        self.most_frames=max(self.most_frames, len(self.waiting))
+        self.most_bytes=max(self.most_bytes, sum(self.waiting))
+        return size
+
+    def recv(self):
+        result=super().recv()
+        self.waiting.pop(0)
+        return result
+
+def test_pipeline_window(scratch):
+    conn=Tracking(pico_sim.serve_pty(), timeout=timeout, window=8, window_bytes=200)
+    try:
+        sources=[f"'{ii:02}'+'{'x'*30}'" for ii in range(30)]
+        results=conn.pipeline(sources)
+        assert [r.value()[:2] for r in results]==[f"{ii:02}" for ii in range(30)]
+        #still pipelined, but never more bytes waiting than the device was promised room for
+        assert conn.most_frames>1
+        assert conn.most_bytes<=200
+        #a frame bigger than the window still goes, on its own
+        conn.most_frames=0
+        assert conn.eval(repr("y"*300))=="y"*300
+        assert conn.most_frames==1
+        #file writes aren't pipelined at all
+        conn.most_frames=0
+        conn.put_bytes(bytes(range(256))*8, "blob.bin")
+        assert conn.most_frames==1
+        assert (scratch/"blob.bin").read_bytes()==bytes(range(256))*8
+    finally:
+        conn.close()
+
+def test_put_and_get_bytes(pico, scratch):
+    data=bytes(range(256))*5 #a few chunks' worth, with every byte value
+    assert pico.put_bytes(data, "blob.bin")==len(data)
+    assert (scratch/"blob.bin").read_bytes()==data
+    assert pico.get_bytes("blob.bin")==data
+    assert pico.put_bytes(b"", "empty.bin")==0
+    assert pico.get_bytes("empty.bin")==b""
+    assert sorted(pico.listdir())==["blob.bin", "empty.bin"]
+    with pytest.raises(serial_repl_client.RemoteError):
+        pico.get_bytes("missing.bin")
+
+def test_put_and_get_files(pico, scratch):
+    (scratch/"local.txt").write_text("some text\n")
+    assert pico.put("local.txt", "remote.txt")==10
+    assert pico.get("remote.txt", "back.txt")==10
+    assert (scratch/"back.txt").read_text()=="some text\n"
+
+def test_bye(scratch):
+    conn=serial_repl_client.Connection(pico_sim.serve_pty(), timeout=timeout)
+    result=conn.exec("bye()")
+    #the device still answers before it goes
+    assert result.error.startswith("SystemExit")
+    assert conn.left
+    #and close() doesn't sit waiting for a device that's gone
+    start=time.monotonic()
+    conn.close()
+    assert time.monotonic()-start<timeout/2
+
+def test_reboot(scratch):
+    conn=serial_repl_client.Connection(pico_sim.serve_pty(), timeout=timeout)
+    result=conn.exec("reboot()")
+    assert result.error.startswith("Reboot")
+    assert conn.left
+    start=time.monotonic()
+    conn.close()
+    assert time.monotonic()-start<timeout/2
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to count fds")
+def test_failed_connect_closes_port(scratch):
+    #a pty with nothing on the other end never answers
+    device, port=pico_sim.open_pty()
+    try:
+        before=open_fds()
+        for ii in range(3):
+            with pytest.raises(TimeoutError):
+                serial_repl_client.Connection(port, timeout=0.2)
+        assert open_fds()==before
+    finally:
+        os.close(device)
+
+def test_pool_dead_port_blocks_only_itself(scratch):
+    device, dead=pico_sim.open_pty()
+    live=pico_sim.serve_pty()
+    try:
+        with serial_repl_client.Pool(timeout=1) as pool:
+            failed=[]
+            def open_dead():
+                try:
+                    pool.get(dead)
+                except TimeoutError:
+                    failed.append(dead)
+            thread=threading.Thread(target=open_dead)
+            thread.start()
+            time.sleep(0.1)
+            #the dead port is still being waited on, the live one opens anyway
+            start=time.monotonic()
+            assert pool.get(live).eval("1")==1
+            assert time.monotonic()-start<0.5
+            thread.join()
+            assert failed==[dead]
+    finally:
+        os.close(device)
+
+def test_pool(scratch):
+    ports=[pico_sim.serve_pty(), pico_sim.serve_pty()]
+    with serial_repl_client.Pool(timeout=timeout) as pool:
+        assert pool.get(ports[0]) is pool.get(ports[0])
+        pool.exec_all(ports, "n=7")
+        results=pool.run(ports, lambda conn: conn.eval("n*6"))
+        assert results=={port: 42 for port in ports}
+        results=pool.exec_all(ports, "1/0")
+        assert all(r.error.startswith("ZeroDivisionError") for r in results.values())
+
+def test_async_pool(scratch):
+    ports=[pico_sim.serve_pty(), pico_sim.serve_pty()]
+    async def run():
+        async with serial_repl_client.AsyncPool(timeout=timeout) as pool:
+            results=await pool.exec_all(ports, "3*3")
+            assert [r.value() for r in results.values()]==[9, 9]
+            pico=await pool.get(ports[0])
+            assert await pico.eval("'async'")=="async"
+            results=await pico.pipeline(["1", "1/0"])
+            assert results[1].error.startswith("ZeroDivisionError")
+            assert await pico.listdir()==[]
+    asyncio.run(run())